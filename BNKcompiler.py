@@ -1,11 +1,20 @@
 # program to pack a number of .wem files into a .bnk file
 
 from struct import pack, unpack
-from struct import error as struct_error
 from fnvhash import fnvhash
+from wem_writer import FileSink, ThreadedFileSink, IncrementalSink
+from wem_pack import WEMPack, has_pack
 from os import walk, path, mkdir, listdir, makedirs
 from collections import OrderedDict as Odict
 from io import BytesIO
+import mmap
+import os
+import shutil
+import sys
+from array import array
+from bisect import bisect_left
+import heapq
+from itertools import repeat
 
 """
 .bnk file structure
@@ -29,7 +38,7 @@ class BNK():
 
         self.counter = counter      # this is set as a IntVar() by the gui to allow for progress tracking
 
-    def extract(self, specific_ids = [], speedmode = False):
+    def extract(self, specific_ids = [], speedmode = False, index = None, sink = None, incremental = False):
         """This is the function that controls the extraction of the wem's and other data from the .bnk
         There are a few parameters this function can be given:
         - specific_ids:
@@ -37,6 +46,14 @@ class BNK():
         - speedmode:
           If set to True, then the data is extracted in a bulk format to allow for far swifter extraction/recompilation
           This is mainly used when just adding streamed files, so only HIRC data needs to be changed
+        - index:
+          A BNKIndex of the bnk (see bnk_index.py). If given it is used instead of reading the chunks and DIDX from the bnk
+        - sink:
+          Where the wems are written to (see wem_writer.py). By default they are written to files in the output path by a pool of threads.
+          If a sink is given it is up to the caller to close it.
+        - incremental:
+          If True, any wems that are already in the output path from a previous extraction and haven't changed are skipped.
+          This uses a manifest file (<name>.manifest) in the output path to keep track of what has been extracted.
         """
         # first, let's create an output directory
         if not path.exists(self.output_path):
@@ -48,43 +65,59 @@ class BNK():
             _input = '{}.BNK'.format(self.name)
         else:
             _input = self.source
-        with open(_input, 'rb') as self.input:
-            cont = True     # tag to check whether or not to keep going
-            while cont == True:
-                tag, data = self.read_bnk_chunk()
-                if tag == None:
-                    cont = False
+        if len(specific_ids) != 0 and speedmode == False:
+            # only a few wems are wanted, so just read those (and the HIRC) straight out of the bnk
+            extract_wems(_input, specific_ids, self.output_path, counter = self.counter, hirc_name = self.name, index = index, sink = sink)
+            return
+        # only the chunk headers are read here, each chunk is then read as it is needed
+        with ChunkDirectory(_input) as directory:
+            self.input = directory.input
+            for tag in directory:
+                if speedmode == False:
+                    # in this case just extract everything as normal.
+                    # we don't actually need to do anything about the header
+                    if tag == 'DIDX':
+                        self.didx = directory.load(tag)
+                    elif tag == 'DATA':
+                        file_sink = sink if sink is not None else ThreadedFileSink(self.output_path)
+                        if incremental:
+                            self.sink = IncrementalSink(file_sink, path.join(self.output_path, '{}.manifest'.format(self.name)), source = _input)
+                        else:
+                            self.sink = file_sink
+                        try:
+                            self.read_data(directory.chunks[tag][0], specific_ids)
+                        finally:
+                            if incremental:
+                                self.sink.close()
+                            if sink is None:
+                                file_sink.close()
+                        if sink is None:
+                            # a sink that was passed in may still have wems to write, so whoever closes it reports it instead
+                            print(self.sink.summary())
+                    elif tag == 'HIRC':
+                        # always write the HIRC data.
+                        self.write_chunk(directory, tag, '{}.hirc'.format(self.name))
                 else:
-                    if speedmode == False:
-                        # in this case just extract everything as normal.
-                        # we don't actually need to do anything about the header
-                        if tag == 'DIDX':
-                            self.wem_sizes = Odict()        # use an ordered dict and use the id's as the keys, and the values are the sizes
-                            self.wem_offsets = []           # list of the offsets of each wem (to save having to get the length and padding it. We get the data anyway, might as well use it...)
-                            self.read_dataindex(data)
-                        elif tag == 'DATA':
-                            self.read_data(data, specific_ids)
-                        elif tag == 'HIRC':
-                            # always write the HIRC data.
-                            with open(path.join(self.output_path, '{}.hirc'.format(self.name)), 'wb') as hirc_file:
-                                hirc_file.write(data.read())
-                    else:
-                        # in this case, just write all the data in a chunk.
-                        if tag == 'DIDX':
-                            with open(path.join(self.output_path, '{}.didx'.format(self.name)), 'wb') as didx_file:
-                                didx_file.write(data.read())
-                        elif tag == 'DATA':
-                            with open(path.join(self.output_path, '{}.data'.format(self.name)), 'wb') as data_file:
-                                data_file.write(data.read())
-                        elif tag == 'HIRC':
-                            with open(path.join(self.output_path, '{}.hirc'.format(self.name)), 'wb') as hirc_file:
-                                hirc_file.write(data.read())
+                    # in this case, just write all the data in a chunk.
+                    if tag == 'DIDX':
+                        self.write_chunk(directory, tag, '{}.didx'.format(self.name))
+                    elif tag == 'DATA':
+                        self.write_chunk(directory, tag, '{}.data'.format(self.name))
+                    elif tag == 'HIRC':
+                        self.write_chunk(directory, tag, '{}.hirc'.format(self.name))
 
     def recompile(self):
         self.included_wems = Odict()
         self.included_hircs = Odict()
 
-        # create a list of all the .wem files in the source directory:
+        # if the bank was extracted into a pack, the wems in it are read straight from there
+        self.pack = None
+        if has_pack(self.source, self.name):
+            self.pack = WEMPack(self.source, self.name)
+            for wem_id in self.pack.ids:
+                self.included_wems[str(wem_id)] = None      # None means the wem is in the pack
+
+        # create a list of all the .wem files in the source directory (any that are also in the pack replace the packed one):
         for root, dirs, files in walk(self.source):
             for file in files:
                 name = path.splitext(file)[0]
@@ -103,11 +136,28 @@ class BNK():
             _output = '{}.BNK'.format(self.name.upper())
         else:
             _output = self.output_path
-        with open(_output, 'wb') as self.output:
-            self.write_header()
-            self.write_dataindex()
-            self.write_data()
-            self.write_hirc()
+        try:
+            with open(_output, 'wb') as self.output:
+                self.write_header()
+                self.write_dataindex()
+                self.write_data()
+                self.write_hirc()
+        finally:
+            if self.pack is not None:
+                self.pack.close()
+
+    def wem_size(self, name):
+        # the size of the included wem called name
+        if self.included_wems[name] is None:
+            return self.pack.locate(name)[1]
+        return path.getsize(self.included_wems[name])
+
+    def read_wem(self, name):
+        # the data of the included wem called name
+        if self.included_wems[name] is None:
+            return self.pack.read(name)
+        with open(self.included_wems[name], 'rb') as data:
+            return data.read()
 
     @staticmethod
     def align16(x):
@@ -115,47 +165,34 @@ class BNK():
         rem = x %16
         return x + (16 - rem)
 
-    def read_bnk_chunk(self):
-        # this will read the tag at the current location in self.input, and then return the data and tag
-        try:
-            tag = self.input.read(4).decode()
-            size = unpack('<I', self.input.read(4))[0]
-            return [str(tag), BytesIO(self.input.read(size))]
-        except:
-            # default empty return, telling the program that the end of the file has been reached
-            return [None, None]
-
-    def read_dataindex(self, data):
-        size = data.getbuffer().nbytes
-        num = int(size/0xC)     # each block is 0xC long...
-        for i in range(num):
-            # for each file, get the ids and sizes of each of the wems
-            wem_id = int(unpack('<I', data.read(4))[0])
-            self.wem_offsets.append(int(unpack('<I', data.read(4))[0]))
-            wem_size = int(unpack('<I', data.read(4))[0])
-            self.wem_sizes[wem_id] = wem_size       # update the dict
-
-    def read_data(self, data, specific_ids):
+    def write_chunk(self, directory, tag, name):
+        # copy the data of a whole chunk straight from the bnk into a file in the output path
+        offset, size = directory.chunks[tag]
+        with open(path.join(self.output_path, name), 'wb', buffering = 0) as chunk_file:
+            copy_range(directory.input, chunk_file, offset, size)
+
+    def read_data(self, data_start, specific_ids):
+        # data_start is the location in self.input of the start of the DATA chunk. Each wem is read from there as it is written
         i = 0
-        for wem_id in self.wem_sizes:
+        for wem_id in self.didx.ids:
             if self.counter is not None:
                 self.counter.set(i + 1)
-            # move the cursor to the current offset (relative to the start of the data chunk)
-            data.seek(self.wem_offsets[i])
-            wem_size = self.wem_sizes[wem_id]
+            # get the location of the wem (relative to the start of the data chunk)
+            wem_offset = data_start + self.didx.offsets[i]
+            wem_size = self.didx.sizes[i]
 
-            # now, read the actual wem data
-            if len(specific_ids) != 0:
+            # now, read the actual wem data (unless the sink doesn't need it)
+            if not self.sink.wants(wem_id, wem_size):
+                pass
+            elif len(specific_ids) != 0:
                 if wem_id in specific_ids:
-                    wem_data = data.read(wem_size)
+                    wem_data = read_at(self.input, wem_size, wem_offset)
                     # ... and write to a file
-                    with open(path.join(self.output_path, '{}.wem'.format(wem_id)), 'wb') as wem_file:
-                        wem_file.write(wem_data)
+                    self.sink.write(wem_id, wem_data)
             else:
-                wem_data = data.read(wem_size)
+                wem_data = read_at(self.input, wem_size, wem_offset)
                 # ... and write to a file
-                with open(path.join(self.output_path, '{}.wem'.format(wem_id)), 'wb') as wem_file:
-                    wem_file.write(wem_data)
+                self.sink.write(wem_id, wem_data)
             
             i += 1
 
@@ -178,7 +215,7 @@ class BNK():
         curr_write_location = 0
         counter = 1
         for file in self.included_wems:
-            filesize = path.getsize(self.included_wems[file])
+            filesize = self.wem_size(file)
             self.output.write(pack('<I', int(file)))                 # file id
             self.output.write(pack('<I', curr_write_location))  # relative offset
             self.output.write(pack('<I', filesize))             # filesize (un-padded)
@@ -197,30 +234,33 @@ class BNK():
         for file in self.included_wems:
             if self.counter is not None:
                 self.counter.set(counter)
-            filesize = path.getsize(self.included_wems[file])
+            filesize = self.wem_size(file)
             if counter != self.num_wems:
                 file_padding = self.align16(filesize) - filesize
             else:
                 file_padding = 0
-            with open(self.included_wems[file], 'rb') as data:
-                self.output.write(data.read())
+            self.output.write(self.read_wem(file))
             if file_padding != 0:
                 self.output.write(pack('{}s'.format(file_padding), b''))
             counter += 1
 
     def write_hirc(self):
+        # first get the total number of entries and size from all the .hirc files so that the header can be written
+        # before any of the data. Each .hirc file can then be copied straight into the output without joining them in memory
+        num_entries = 0
+        new_hirc_size = 4           # number of entries field
+        for hirc in self.included_hircs:
+            with open(self.included_hircs[hirc], 'rb') as hirc_file:
+                num_entries += unpack('<I', hirc_file.read(4))[0]
+            new_hirc_size += path.getsize(self.included_hircs[hirc]) - 4
         # write the header
         self.output.write(pack('4s', b'HIRC'))
-        counter = 0
-        for hirc in self.included_hircs:
-            if counter == 0:
-                new_hirc = HIRC(self.included_hircs[hirc])
-                counter += 1
-            else:
-                new_hirc += HIRC(self.included_hircs[hirc])
-        new_hirc_size = new_hirc.data.getbuffer().nbytes
         self.output.write(pack('<I', new_hirc_size))
-        self.output.write(new_hirc.data.getbuffer())
+        self.output.write(pack('<I', num_entries))
+        for hirc in self.included_hircs:
+            with open(self.included_hircs[hirc], 'rb') as hirc_file:
+                hirc_file.seek(4)
+                shutil.copyfileobj(hirc_file, self.output)
 
 """ New versions of the entire above section follows """
 
@@ -228,25 +268,33 @@ class BNK():
 class BNK_new():
     """ New BNK class
     This class can be created from a bnk file and manipulated in such a way that extraction, addition, and (soon) replacement is possible
+
+    If mapped is True the bnk is memory-mapped instead of being read in. The small sections are still copied,
+    but the DATA section and every WEM in it are just memoryview slices of the mapping, so nothing is
+    actually read from disk until a WEM is written out or replaced. Call close() (or use a with block) when done.
     """
-    def __init__(self, path = None, data = None):
+    def __init__(self, path = None, data = None, mapped = False):
+        self.source_path = path
+        self._mmap = None
+        self.plan = None            # LayoutPlan of the DATA section, once it has been worked out
         if data is None:
-            if path is not None:
-                with open(path, 'rb') as _input:
+            if path is not None and mapped:
+                self.read_mapped(path)
+            elif path is not None:
+                with ChunkDirectory(path) as directory:
                     self.data = Odict()
                     # first, let's just make sure we have been given a BNK file:
-                    if unpack('4s', _input.read(4))[0] == b'BKHD':
+                    if directory.isbnk():
                         # yep, we *should* be good...
-                        _input.seek(0)      # return to start
                         # we go through the rest of the data and populate self.data
-                        self.cont = True     # tag to check whether or not to keep going
-                        while self.cont == True:
-                            self.read_bnk_chunk(_input)
+                        for tag in directory:
+                            print('tag', tag)
+                            self.data[tag] = directory.load(tag)
             # now that we have the data all sorted, apply a bit of processing to it...
             # first, pass the DIDX data to the DATA data so that it can split it's data into individual WEM files
-            try:
-                self.data['DATA'].split(self.data['DIDX'])
-            except:
+            if self.data.get('DATA') is not None and self.data.get('DIDX') is not None:
+                self.data['DATA'].split(self.data['DIDX'], source = path)
+            else:
                 # in this case we have no self.data['DATA']
                 self.data['DATA'] = None
         else:
@@ -258,6 +306,24 @@ class BNK_new():
             except:
                 pass
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        # release the memory map (if any). Any WEM's still pointing into it are dropped first so that the map can actually be closed
+        if self._mmap is not None:
+            if self.data.get('DATA') is not None:
+                self.data['DATA'].release()
+            try:
+                self._mmap.close()
+            except BufferError:
+                # something outside of this object still holds a view of the map. It will be closed once that is garbage collected
+                pass
+            self._mmap = None
+
     def __add__(self, other):
         # we need to check for empty DIDX and DATA section (HIRC shouldn't be empty ever...)
         try:
@@ -306,16 +372,20 @@ class BNK_new():
 
         # first, create a wem from the actual data
         with open(wem, 'rb') as data:
-            new_wem = WEM(BytesIO(data.read()))
+            new_wem = WEM(data.read())
 
         # now, we need to replace it in the wem_data of self.data['DATA']
-        try:
-            self.data['DATA'].wem_data[str(id_)] = new_wem
-        except KeyError:
-            raise KeyError  # is this redundant as it would just happen anyway? Might just leave it for now in case I want to change it...
-
-        # only thing left to do is correct the offsets and redo all the data which is handled by correct_offsets()
-        self.correct_offsets()
+        if int(id_) not in self.data['DATA'].wem_data:
+            raise KeyError(id_)
+        self.data['DATA'].wem_data[int(id_)] = new_wem
+
+        # only thing left to do is correct the offsets. If we already have a layout then only the wems that need to move are changed
+        # (the DIDX shares its columns with the plan, so that is updated along with it)
+        if self.plan is not None:
+            self.plan.resize({int(id_): len(new_wem)})
+            self.data['DIDX'].setdata(self.plan)
+        else:
+            self.correct_offsets()
 
     def save(self, path_):
         # saves the current bnk files to disc (at location path)
@@ -325,41 +395,188 @@ class BNK_new():
         name_hash = fnvhash(path.splitext(path.basename(path_))[0])
         # now we need to actually change the value in the BKHD section...
         self.data['BKHD'].sethash(name_hash)
-        
-        with open(path_, 'wb') as output:
-            for key in self.data:
-                output.write(self.data[key].getdata())
 
-    def read_bnk_chunk(self, input_):
-        # this will read the tag at the current location in self.input, and then return the data and tag
+        # The bnk is streamed straight to the file instead of being joined together in memory first.
+        # To do this we need to know where every wem will go before anything is written, so lay it all out first.
+        if self.plan is None:
+            self.correct_offsets()
+        plan = self.plan
+        if self.data.get('DATA') is not None:
+            wem_data = self.data['DATA'].wem_data
+        else:
+            wem_data = dict()
+        didx = plan.getdidx()
+
+        sources = dict()        # open file objects of any bnk's that unchanged wems can be copied from
+        locations = dict()      # id: where each wem ends up in the new file
+        # the bnk is written to a temporary file first and only put in place at the end, as the wems may well be being
+        # copied from the very file that is being saved over (eg. when a bnk is loaded, changed and saved back again)
+        tmp_path = path_ + '.tmp'
+        try:
+            # unbuffered, as everything here is written in big pieces anyway
+            with open(tmp_path, 'wb', buffering = 0) as output:
+                for key in self.data:
+                    if self.data[key] is None:
+                        continue
+                    elif key == 'DIDX':
+                        write_buffers(output, [b'DIDX', pack('<I', len(didx)), didx])
+                    elif key == 'DATA':
+                        write_buffers(output, [b'DATA', pack('<I', plan.data_size)])
+                        for i in range(len(plan)):
+                            wem = wem_data[plan.ids[i]]
+                            padding = bytes(plan.padding(i))
+                            locations[plan.ids[i]] = output.tell()
+                            if wem.source is not None and HAS_KERNEL_COPY:
+                                # the wem is unchanged from one on disk, so have the os copy it across
+                                if wem.source[0] not in sources:
+                                    sources[wem.source[0]] = open(wem.source[0], 'rb')
+                                copy_range(sources[wem.source[0]], output, wem.source[1], len(wem))
+                                write_buffers(output, [padding])
+                            else:
+                                write_buffers(output, [wem.getdata(), padding])
+                    else:
+                        write_buffers(output, self.data[key].getbuffers())
+        except BaseException:
+            for source in sources.values():
+                source.close()
+            if path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        for source in sources.values():
+            source.close()
+        # a file that is memory-mapped can't be replaced on windows, so if this is the bnk that is mapped let go of the map first
+        # (the wems that were slices of it are then mapped again from whichever file ends up at the path)
+        remap = None
+        if self._mmap is not None and path.exists(path_) and path.samefile(self.source_path, path_):
+            remap = {wem_id: len(wem) for wem_id, wem in wem_data.items() if isinstance(wem.data, memoryview)}
+            old_sources = {wem_id: wem_data[wem_id].source for wem_id in remap}
+            self.close()
         try:
-            tag = input_.read(4).decode()       # use this over decode to just get the data as binary for convenience when writing later...
-            print('tag', tag)
-            size = unpack('<I', input_.read(4))[0]
-            cls = eval(tag)
-            self.data[tag] = cls(data = BytesIO(input_.read(size)))
-        except struct_error:
-            # break the loop
-            self.cont = False
-        except NameError:
-            # class not defined for the sub section of the BNK...
-            print("Class {} doesn't exists...".format(tag.decode()))
+            os.replace(tmp_path, path_)
+        except OSError:
+            os.remove(tmp_path)
+            if remap is not None:
+                # the old file is still there, so put its wems back the way they were
+                self.map_wems(path_, {wem_id: (old_sources[wem_id][1], size) for wem_id, size in remap.items()})
+            raise
+        # every wem is now unchanged from the one in the new file (and any that came from the old file at this path can't
+        # be copied from there any more as it has been replaced)
+        for wem_id, offset in locations.items():
+            wem_data[wem_id].source = (path_, offset)
+        if remap is not None:
+            self.map_wems(path_, {wem_id: (locations[wem_id], size) for wem_id, size in remap.items()})
+
+    def map_wems(self, path_, wems):
+        # memory-map the bnk at path_ and point each of the wems at its data in it. wems is id: (absolute offset, size)
+        with open(path_, 'rb') as input_:
+            self._mmap = mmap.mmap(input_.fileno(), 0, access = mmap.ACCESS_READ)
+        view = memoryview(self._mmap)
+        for wem_id, (offset, size) in wems.items():
+            self.data['DATA'].wem_data[wem_id].data = view[offset:offset + size]
+        self.source_path = path_
+
+    def read_mapped(self, path_):
+        # map the bnk into memory read only and split it up into its sections without copying the DATA section
+        self.data = Odict()
+        with ChunkDirectory(path_) as directory:
+            if not directory.isbnk():
+                return
+            self._mmap = mmap.mmap(directory.input.fileno(), 0, access = mmap.ACCESS_READ)
+            view = memoryview(self._mmap)
+            for tag in directory:
+                offset, size = directory.chunks[tag]
+                if tag == 'DATA':
+                    # start_pos is the absolute location of the first wem in the file
+                    self.data[tag] = DATA(view[offset:offset + size], start_pos = offset)
+                else:
+                    # the other sections are tiny in comparison so just load them normally
+                    self.data[tag] = directory.load(tag)
 
     def correct_offsets(self):
         # this will determine the size of the BKHD and DIDX sections (+ the 4 bytes for the DATA tag),
         # and then use this offset to generate the offsets for each wem file in DATA
         if self.data is not None:
+            if self.data.get('DATA') is None:
+                # no wems, so an empty layout
+                self.plan = LayoutPlan([], [], 0)
+                return
             # add all the tags and section length data to the actual lengths of the sections
-            self.data['DATA'].start_pos = 8 + len(self.data['BKHD']) + 8 + len(self.data['DIDX']) + 8
+            # the DIDX will have one entry per wem, so get its size from that and not what it was before
+            start_pos = 8 + len(self.data['BKHD']) + 8 + 0xC * len(self.data['DATA'].wem_data) + 8
             # initial 8 bytes + len of the BKHD section
             # tag and length of DIDX
             # tag and length of DATA
 
-            # next, call the command on the DATA object to renerate a new set of wem offsets
-            new_wem_offsets = self.data['DATA'].setdata()
+            # next, get the DATA object to lay out all its wems (this doesn't touch any of the actual wem data)
+            self.plan = self.data['DATA'].setdata(start_pos)
 
             # and finally, correct all the offsets in the DIDX section:
-            self.data['DIDX'].setdata(new_wem_offsets)
+            if self.data.get('DIDX') is not None:
+                self.data['DIDX'].setdata(self.plan)
+
+class ChunkDirectory():
+    """
+    The location of each chunk in a bnk file. Only the 8 byte tag and size header of each chunk is read to make this,
+    and the chunks themselves are only read (and loaded into the right section class) when they are asked for with load().
+    """
+    def __init__(self, path_, mode = 'rb'):
+        self.path = path_
+        self.input = open(path_, mode)          # mode can be 'r+b' to allow the bnk to be changed in place
+        self.chunks = read_chunk_table(self.input)      # tag: (offset of the chunk data, size of the chunk data)
+        self.sections = dict()      # any sections that have been loaded already
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __iter__(self):
+        return iter(self.chunks)
+
+    def __contains__(self, tag):
+        return tag in self.chunks
+
+    def close(self):
+        self.input.close()
+
+    def isbnk(self):
+        # a bnk always starts with the BKHD section
+        return len(self.chunks) != 0 and next(iter(self.chunks)) == 'BKHD'
+
+    def read(self, tag):
+        # returns the raw data of the chunk
+        offset, size = self.chunks[tag]
+        return read_at(self.input, size, offset)
+
+    def load(self, tag):
+        # returns the chunk loaded into its section class (or a Chunk if we don't have a class for it)
+        if tag not in self.sections:
+            if tag == 'DATA':
+                # keep track of where the wems start in the file so that they can be copied straight from it later
+                self.sections[tag] = DATA(BytesIO(self.read(tag)), start_pos = self.chunks[tag][0])
+            elif tag in SECTION_TYPES:
+                self.sections[tag] = SECTION_TYPES[tag](data = BytesIO(self.read(tag)))
+            else:
+                self.sections[tag] = Chunk(BytesIO(self.read(tag)), tag = tag)
+        return self.sections[tag]
+
+
+class Chunk():
+    """ Any section of a bnk that we don't have a class for. The data is just kept as is so that it can be written back out unchanged """
+    def __init__(self, data, **kwargs):
+        self.data = data
+        self.tag = kwargs.get('tag', '????').encode()
+
+    def __len__(self):
+        return len(self.data.getbuffer())
+
+    def getdata(self):
+        return self.tag + pack('<I', len(self)) + self.data.getvalue()
+
+    def getbuffers(self):
+        return [self.tag, pack('<I', len(self)), self.data.getbuffer()]
+
 
 class BKHD():
     """
@@ -387,85 +604,133 @@ class BKHD():
     def getdata(self):
         return self.tag + pack('<I', len(self)) + self.data.getvalue()
 
+    def getbuffers(self):
+        # same as getdata but as a list of buffers so that they can be written without being joined
+        return [self.tag, pack('<I', len(self)), self.data.getbuffer()]
+
 class DIDX():
     """
     Data Index Entry (0xC chunks):
     +0x000			0x4			int			-			audio file id (hashed version of name)
     +0x004			0x4			int			-			relative file offset from start of DATA, 16 bytes aligned
     +0x008			0x4			int			-			file size
+
+    The entries are stored as three columns (ids, offsets and sizes), each an array('I'), which are read in one go from the raw data.
     """
     def __init__(self, data, **kwargs):
         self.tag = b'DIDX'
-        self.data = data            # this is a BytesIO object
-
-        # the following two Odict's contain all the data here really once it is serialised back. Maybe better to just store it here and delete self.data?
-        self.wem_sizes = kwargs.get('wem_sizes', Odict())        # use an ordered dict and use the id's as the keys, and the values are the sizes
-        self.wem_offsets = kwargs.get('wem_offsets', Odict())
 
-        # have a block to check if the DIDX has been created from an addition. If so we don't actually want to run the following code:
+        # have a block to check if the DIDX has been created from an addition. If so we don't actually want to read the data:
         if not kwargs.get('added', False):
-            self.num_entries = int(len(self)/0xC)     # each block is 0xC long...
-            for i in range(self.num_entries):
-                # for each file, get the ids and sizes of each of the wems
-                wem_id = int(unpack('<I', self.data.read(4))[0])
-                self.wem_offsets[wem_id] = int(unpack('<I', self.data.read(4))[0])
-                wem_size = int(unpack('<I', self.data.read(4))[0])
-                self.wem_sizes[wem_id] = wem_size       # update the dict
+            self.ids, self.offsets, self.sizes = unpack_entries(data.getbuffer())
+        else:
+            self.ids = kwargs.get('ids', array('I'))
+            self.offsets = kwargs.get('offsets', array('I'))
+            self.sizes = kwargs.get('sizes', array('I'))
+        self.num_entries = len(self.ids)
+        self.sort_index()
 
         # read off the offset of the final data entry in DATA, and it's size and add together
         # this is the total size of the self.data chunk in the DATA section
-        self.data_size = self.wem_offsets[next(reversed(self.wem_offsets))] + self.wem_sizes[next(reversed(self.wem_sizes))] ## I don't think this is even used??? Was made redundant at some point...
+        self.data_size = max((self.offsets[i] + self.sizes[i] for i in range(self.num_entries)), default = 0) ## I don't think this is even used??? Was made redundant at some point...
 
     def __len__(self):
-        return len(self.data.getvalue())
+        return 0xC * len(self.ids)
+
+    def __contains__(self, wem_id):
+        return self.find(wem_id) is not None
 
     def __add__(self, other):
         # we will need to adjust all the data here since it will all become re-ordered due to merging with another file
         print('self: {0}, other: {1}'.format(len(self), len(other)))
-        #total_data = BytesIO(self.data.getvalue() + other.data.getvalue())
-        # combine the two ordered dicts for each DIDX section
-        new_wem_sizes = Odict(self.wem_sizes)
-        new_wem_sizes.update(other.wem_sizes)
-        new_wem_offsets = Odict(self.wem_offsets)
-        new_wem_offsets.update(other.wem_offsets)
-
-        # now we need to do some stuff...
-        # first, we need to sort both ordered dicts by key
-        sorted_wem_sizes = Odict(sorted(new_wem_sizes.items()))
-        del new_wem_sizes       # let's delete it to save memory...
-        sorted_wem_offsets = Odict(sorted(new_wem_offsets.items()))
-        del new_wem_offsets
-        
-        return DIDX(BytesIO(b''), wem_sizes = sorted_wem_sizes, wem_offsets = sorted_wem_offsets, added = True)
-
-    def setdata(self, new_offsets):
-        # this gets an ordered dictionary of the wem offsets and writes the values to the data section.
+        # join the columns together, with the entries of other replacing any in self with the same id, and sort the result
+        ids = self.ids + other.ids
+        offsets = self.offsets + other.offsets
+        sizes = self.sizes + other.sizes
+        order = sorted_unique(ids)
+        return DIDX(None, ids = take(ids, order), offsets = take(offsets, order), sizes = take(sizes, order), added = True)
+
+    def sort_index(self):
+        # set up what is needed to find ids quickly. NMS's DIDX's are always sorted by id, in which case the ids column is just used as is.
+        if all(self.ids[i] < self.ids[i + 1] for i in range(len(self.ids) - 1)):
+            self._order = None
+            self._sorted_ids = self.ids
+        else:
+            self._order = array('I', sorted(range(len(self.ids)), key = self.ids.__getitem__))
+            self._sorted_ids = take(self.ids, self._order)
+
+    def find(self, wem_id):
+        # returns the index of the entry with the id wem_id, or None if there isn't one
+        i = bisect_left(self._sorted_ids, wem_id)
+        if i != len(self._sorted_ids) and self._sorted_ids[i] == wem_id:
+            if self._order is None:
+                return i
+            return self._order[i]
+        return None
+
+    def get(self, wem_id):
+        # returns the (offset, size) of the wem with the id wem_id
+        i = self.find(wem_id)
+        if i is None:
+            raise KeyError(wem_id)
+        return self.offsets[i], self.sizes[i]
+
+    def sort(self):
+        # sort all the entries by id
+        if self._order is not None:
+            self.offsets = take(self.offsets, self._order)
+            self.sizes = take(self.sizes, self._order)
+            self.ids = self._sorted_ids
+            self.sort_index()
+
+    def setdata(self, plan):
+        # this gets the LayoutPlan of the DATA section and updates the entries to match it.
         # we will assume that the order of entries is the same as the wem orders, as it should be because the two were created and ordered identically
-        # new_offsets is a tuple of (offset, data_size)
-
-        self.data = BytesIO()
-        
-        # now go through and write each one
-        for wem_id in new_offsets:
-            self.data.write(pack('<I', wem_id))                     # id
-            self.data.write(pack('<I', new_offsets[wem_id][0]))     # offset
-            self.data.write(pack('<I', new_offsets[wem_id][1]))     # wem size
-        self.data.seek(0)   # just to reset it in case...
+        # The columns of the plan are used as they are (not copied), so whenever the plan is changed after this (eg. by
+        # LayoutPlan.resize) the entries already match it, and the ids only need indexing again if they are new ones
+        ids_changed = self.ids is not plan.ids
+        self.ids = plan.ids
+        self.offsets = plan.offsets
+        self.sizes = plan.sizes
+        self.num_entries = len(self.ids)
+        if ids_changed:
+            self.sort_index()
 
     def getdata(self):
         print('length: {}'.format(len(self)))
-        return self.tag + pack('<I', len(self)) + self.data.getvalue()
+        return self.tag + pack('<I', len(self)) + pack_entries(self.ids, self.offsets, self.sizes)
+
+    def getbuffers(self):
+        return [self.tag, pack('<I', len(self)), pack_entries(self.ids, self.offsets, self.sizes)]
         
 
 class DATA():
     def __init__(self, data, **kwargs):
         self.tag = b'DATA'
-        self.data = data
+        self.data = data            # either a BytesIO, or a memoryview if the bnk was memory-mapped
         self.wem_data = kwargs.get('wem_data', Odict())
         self.start_pos = kwargs.get('start_pos', 0x0)        # this will be the location that the data starts at (after b'DATA' and the length of the section)
+        self.plan = None            # the LayoutPlan from the last call to setdata, if any
 
     def __len__(self):
-        return len(self.data.getvalue())
+        if self.plan is not None:
+            return self.plan.data_size
+        return len(self.getbuffer())
+
+    def getbuffer(self):
+        # returns the raw data of the section without copying it
+        if isinstance(self.data, memoryview):
+            return self.data
+        return self.data.getbuffer()
+
+    def release(self):
+        # drop any views into a memory-mapped bnk
+        for wem in self.wem_data.values():
+            if isinstance(wem.data, memoryview):
+                wem.data.release()
+        if isinstance(self.data, memoryview):
+            self.data.release()
+            self.data = BytesIO(b'')
 
     def __add__(self, other):
         # Need to be careful here. We cannot simply add the two data's together as we require some padding between...
@@ -476,55 +741,112 @@ class DATA():
         
         return DATA(BytesIO(b''), wem_data = sorted_new_wem_data)        # give it an empty byte string just so that things like len(~) don't spit an error...
 
-    def split(self, didx_data):
+    def split(self, didx_data, source = None):
         # this will take the didx data, and use it to split the self.data into individual WEM objects
-        for key in didx_data.wem_sizes:
+        # source is the path of the bnk the data came from (if any) so that each wem knows where it can be copied from when saving
+        if isinstance(self.data, memoryview):
+            # memory-mapped, so each WEM is just a slice of the mapping and nothing gets read yet
+            for key, offset, size in zip(didx_data.ids, didx_data.offsets, didx_data.sizes):
+                self.wem_data[key] = WEM(self.data[offset:offset + size], source = self.wem_source(source, offset))
+            return
+        for key, offset, size in zip(didx_data.ids, didx_data.offsets, didx_data.sizes):
             # first, move to the right spot
-            self.data.seek(didx_data.wem_offsets[key])
+            self.data.seek(offset)
             # then read the right amount
-            self.wem_data[key] = WEM(self.data.read(didx_data.wem_sizes[key]))
+            self.wem_data[key] = WEM(self.data.read(size), source = self.wem_source(source, offset))
         # I guess we will keep the self.data, although really we don't need it, and should probably remove it from memory to save space, especially for large bnk's.
         # del self.data
 
+    def wem_source(self, source, offset):
+        # the location of a wem in the original bnk, as (path, absolute offset)
+        if source is None:
+            return None
+        return (source, self.start_pos + offset)
+
     def extract(self, _id):
         # returns the WEM's with the corresponding id
         return self.wem_data[_id]
 
-    def setdata(self):
+    def setdata(self, start_pos = None):
         # this will be called on DATA objects created from the merging of two other DATA objects.
-        # we want to get all the wem objects and create the self.data again from it
-        # we will also need to output some info that contains all the offsets so that the DIDX section of the BNK can be set
-        wem_offsets = Odict()
-        wems = list(self.wem_data.keys())
-        # refresh self.data
-        self.data = BytesIO()
-        curr_location = 0
-        for wem in wems:
-            #print(hex(int(wem)), len(self.wem_data[wem]))
-            # set the offset of the wem to be equal to the current length of self.data
-            wem_offsets[wem] = (curr_location, len(self.wem_data[wem]))
-            # now actually add on the wem's data and offset if required
-            self.data.write(self.wem_data[wem].getdata())
-            curr_location += len(self.wem_data[wem])
-            if wems.index(wem) == 0 and wems.index(wem) != len(wems) - 1:   # make sure it isn't also the last in case there is only one element...
-                # only need to add the offset to the first entry
-                file_padding = align16(len(self.wem_data[wem]) + self.start_pos)
-                first = False
-            elif wems.index(wem) != len(wems) - 1:
-                # after this, the entries will now be aligned to 0x10, so we can just call align16 on the length
-                file_padding = align16(len(self.wem_data[wem]))
-            else:
-                file_padding = 0
-            if file_padding != 0:
-                self.data.write(pack('{}s'.format(file_padding), b''))
-            curr_location += file_padding
-
-        return wem_offsets
+        # we want to work out where each of the wem objects goes, and return the LayoutPlan so that the DIDX section of the BNK can be set
+        # None of the wem data is touched here, it is only written out when the bnk is saved (or getdata is called)
+        if start_pos is not None:
+            self.start_pos = start_pos
+        self.plan = LayoutPlan(self.wem_data.keys(), [len(wem) for wem in self.wem_data.values()], self.start_pos)
+        return self.plan
 
     def getdata(self):
-        return self.tag + pack('<I', len(self)) + self.data.getvalue()
+        if self.plan is None:
+            return self.tag + pack('<I', len(self)) + bytes(self.getbuffer())
+        # build the data back up from the wems
+        data = [self.tag, pack('<I', len(self))]
+        for i in range(len(self.plan)):
+            data.append(bytes(self.wem_data[self.plan.ids[i]].getdata()))
+            data.append(bytes(self.plan.padding(i)))
+        return b''.join(data)
         
 
+class LayoutPlan():
+    """
+    Where each wem goes in the DATA section of a bnk.
+    All three columns are in the same order as the wems (and the DIDX entries), and the offsets are relative to the start of the DATA section.
+    Every wem after the first one starts on a 16 byte boundary in the file, which is why start_pos (the position of the DATA section in the file) is needed.
+    """
+    def __init__(self, ids, sizes, start_pos = 0):
+        self.ids = array('I', ids)
+        self.sizes = array('I', sizes)
+        self.offsets = array('I', bytes(4 * len(self.ids)))
+        self.start_pos = start_pos
+        self.index = {wem_id: i for i, wem_id in enumerate(self.ids)}     # position of each id in the columns
+        self.data_size = 0
+        self.layout()
+
+    def __len__(self):
+        return len(self.ids)
+
+    def layout(self, start = 0):
+        # work out the offsets of every wem from index start onwards in one pass
+        if start < len(self.ids):
+            curr_location = self.offsets[start]
+        else:
+            curr_location = self.data_size
+        last = len(self.ids) - 1
+        for i in range(start, len(self.ids)):
+            self.offsets[i] = curr_location
+            curr_location += self.sizes[i]
+            if i != last:
+                curr_location += align16(curr_location + self.start_pos)
+        self.data_size = curr_location
+
+    def padding(self, i):
+        # the number of empty bytes that go after the i'th wem
+        if i == len(self.ids) - 1:
+            return self.data_size - self.offsets[i] - self.sizes[i]
+        return self.offsets[i + 1] - self.offsets[i] - self.sizes[i]
+
+    def resize(self, changes):
+        """ Update the plan for a few wems that have changed size.
+        changes is a dictionary of id: new size. Any wem that still fits in its old space (including padding) stays put and nothing else moves,
+        so this is only as much work as the number of changes. Only if a wem grows past the next one is everything after it moved along. """
+        first_moved = None
+        last = len(self.ids) - 1
+        for wem_id, size in changes.items():
+            i = self.index[wem_id]
+            self.sizes[i] = size
+            if i == last:
+                self.data_size = self.offsets[i] + size
+            elif self.offsets[i] + size > self.offsets[i + 1]:
+                if first_moved is None or i < first_moved:
+                    first_moved = i
+        if first_moved is not None:
+            self.layout(first_moved)
+
+    def getdidx(self):
+        # the DIDX entries for the plan (id, offset, size for each wem)
+        return pack_entries(self.ids, self.offsets, self.sizes)
+
+
 class HIRC():
     """
     This is a class to load an HIRC file into that will allow it to be merged (and maybe in the future more...)
@@ -538,27 +860,35 @@ class HIRC():
         """ this will probably need to be reformatted at some point... """        
         self.tag = b'HIRC'
         self.data = data
-        self.entries = kwargs.get('entries', unpack('<I', data.read(4))[0])
+        if 'entries' in kwargs:
+            self.entries = kwargs['entries']
+        else:
+            self.entries = unpack('<I', data.read(4))[0]
         if not kwargs.get('added', False):
             self.data = BytesIO(self.data.read())        # this will make the data be everything except the first 4 bytes which are the amount of HIRC entries. Not sure if there is a better way?
-        print(len(self.data.getvalue()))
+        # added HIRC's just keep a list of the data of each of the HIRC's they were made from instead of joining it all together
+        self.segments = kwargs.get('segments', [self.data])
+        print(len(self))
 
     def __len__(self):
-        return len(self.data.getvalue()) + 4            # we need a + 4 to take into account of the number of entries field (4 byte int)
+        return sum(len(segment.getbuffer()) for segment in self.segments) + 4            # we need a + 4 to take into account of the number of entries field (4 byte int)
 
     def __add__(self, other):
         total_entries = self.entries + other.entries
-        total_data = BytesIO(self.data.getvalue() + other.data.getvalue())
-        return HIRC(total_data, entries = total_entries, added = True)
+        return HIRC(BytesIO(b''), entries = total_entries, segments = self.segments + other.segments, added = True)
 
     def getdata(self):
         # return all the data and header of the section
-        return self.tag + pack('<I', len(self)) + pack('<I', self.entries) + self.data.getvalue()       # tag, size of HIRC section, number of entries, and then data respectively
+        return b''.join(self.getbuffers())       # tag, size of HIRC section, number of entries, and then data respectively
+
+    def getbuffers(self):
+        return [self.tag, pack('<I', len(self)), pack('<I', self.entries)] + [segment.getbuffer() for segment in self.segments]
         
 class WEM():
     def __init__(self, data, **kwargs):
         self.__slots__ = ['data', '__len__']
-        self.data = data        # this is just the raw bytes
+        self.data = data        # this is just the raw bytes (or a memoryview into a memory-mapped bnk)
+        self.source = kwargs.get('source', None)        # (path, offset) of this wem in a bnk on disk, if it is unchanged from it
 
     def __len__(self):
         return len(self.data)
@@ -598,6 +928,291 @@ class HIRC_old():
             output.write(pack('<I', event_id))
         
 
+# whether or not the os can copy data between two files by itself (without it having to come through python)
+HAS_KERNEL_COPY = hasattr(os, 'copy_file_range') or hasattr(os, 'sendfile')
+
+def copy_range(src, dst, offset, count):
+    """ Copy count bytes from offset in the file src to the current position of the file dst.
+    dst needs to be unbuffered as the copy is done directly on the file descriptors where possible. """
+    if hasattr(os, 'copy_file_range'):
+        try:
+            while count > 0:
+                copied = os.copy_file_range(src.fileno(), dst.fileno(), count, offset)
+                if copied == 0:
+                    break
+                offset += copied
+                count -= copied
+            return
+        except OSError:
+            # not supported between these two files (eg. they are on different filesystems on an older kernel)
+            pass
+    if hasattr(os, 'sendfile'):
+        try:
+            while count > 0:
+                copied = os.sendfile(dst.fileno(), src.fileno(), offset, count)
+                if copied == 0:
+                    break
+                offset += copied
+                count -= copied
+            return
+        except OSError:
+            pass
+    # fall back to copying through a buffer
+    src.seek(offset)
+    while count > 0:
+        block = src.read(min(count, 0x100000))
+        if not block:
+            break
+        write_buffers(dst, [block])
+        count -= len(block)
+
+def write_buffers(dst, buffers):
+    # write a list of buffers to the (unbuffered) file dst in one go if possible
+    buffers = [buffer for buffer in buffers if len(buffer) != 0]
+    if hasattr(os, 'writev'):
+        total = sum(len(buffer) for buffer in buffers)
+        while total > 0:
+            written = os.writev(dst.fileno(), buffers)
+            total -= written
+            if total == 0:
+                break
+            # only part of it was written, so drop whatever has been
+            while written >= len(buffers[0]):
+                written -= len(buffers[0])
+                del buffers[0]
+            buffers[0] = memoryview(buffers[0])[written:]
+    else:
+        for buffer in buffers:
+            dst.write(buffer)
+
+def read_chunk_table(input_):
+    """ Read the tag and size of each chunk in the open bnk file input_, seeking past the actual data of each one.
+    Returns an ordered dictionary of tag: (offset of the chunk data in the file, size of the chunk data) """
+    chunks = Odict()
+    input_.seek(0)
+    while True:
+        header = input_.read(8)
+        if len(header) < 8:
+            # end of the file
+            break
+        tag, size = unpack('<4sI', header)
+        chunks[tag.decode()] = (input_.tell(), size)
+        input_.seek(size, 1)
+    return chunks
+
+def read_at(input_, size, offset):
+    # read size bytes at offset in the file input_. Uses a positioned read if the os has it so that the file position isn't shared
+    if hasattr(os, 'pread'):
+        data = os.pread(input_.fileno(), size, offset)
+        # pread can return less than was asked for, so keep going until we have it all
+        while len(data) < size:
+            block = os.pread(input_.fileno(), size - len(data), offset + len(data))
+            if not block:
+                break
+            data += block
+        return data
+    input_.seek(offset)
+    return input_.read(size)
+
+def extract_wems(bnk_path, ids, output_path, counter = None, hirc_name = None, index = None, sink = None):
+    """ Extract just the wems with the given ids from the bnk at bnk_path into output_path.
+    Only the chunk headers, the DIDX and the requested wems are read, all from the one open file.
+    If a BNKIndex of the bnk is given as index, the chunk headers and DIDX are taken from that instead.
+    If hirc_name is given, the HIRC is also written out as <hirc_name>.hirc (like BNK.extract does).
+    The wems are written to sink if one is given (which the caller then needs to close), otherwise to files in output_path.
+    Returns a list of any of the ids that aren't in the bnk. """
+    if not path.exists(output_path):
+        makedirs(output_path)
+    missing = []
+    with open(bnk_path, 'rb') as input_:
+        if index is not None:
+            chunks = index.chunks
+            didx = index.didx
+        else:
+            chunks = read_chunk_table(input_)
+            didx = None
+        if hirc_name is not None and 'HIRC' in chunks:
+            with open(path.join(output_path, '{}.hirc'.format(hirc_name)), 'wb') as hirc_file:
+                hirc_file.write(read_at(input_, chunks['HIRC'][1], chunks['HIRC'][0]))
+        if 'DIDX' not in chunks or 'DATA' not in chunks:
+            return list(ids)
+        if didx is None:
+            didx = DIDX(BytesIO(read_at(input_, chunks['DIDX'][1], chunks['DIDX'][0])))
+        data_start = chunks['DATA'][0]
+        wem_sink = sink if sink is not None else FileSink(output_path)
+        for i, wem_id in enumerate(ids):
+            if counter is not None:
+                counter.set(i + 1)
+            try:
+                offset, size = didx.get(int(wem_id))
+            except KeyError:
+                missing.append(wem_id)
+                continue
+            wem_sink.write(wem_id, read_at(input_, size, data_start + offset))
+    if sink is None:
+        wem_sink.close()
+    return missing
+
+def patch_wem(bnk_path, wem_id, wem):
+    """ Replace the wem with the id wem_id in the bnk at bnk_path with the wem file wem, changing the bnk in place.
+    If the new wem fits in the space of the old one (including its padding) it is written over the old one,
+    and the only other thing that changes is its size in the DIDX.
+    Otherwise it is put on the end of the DATA section, and just its DIDX entry, the DATA size and any sections after DATA are rewritten.
+    Returns True if the wem was replaced where it was. """
+    with open(wem, 'rb') as wem_file:
+        new_data = wem_file.read()
+    with ChunkDirectory(bnk_path, mode = 'r+b') as directory:
+        output = directory.input
+        didx = directory.load('DIDX')
+        i = didx.find(int(wem_id))
+        if i is None:
+            raise KeyError(wem_id)
+        didx_start = directory.chunks['DIDX'][0]
+        data_start, data_size = directory.chunks['DATA']
+        offset, size = didx.offsets[i], didx.sizes[i]
+        # the old wem's space goes up to whichever wem comes after it in the DATA section (or the end of it)
+        slot_end = min((o for o in didx.offsets if o > offset), default = data_size)
+
+        if len(new_data) <= slot_end - offset:
+            # it fits! Write it over the old one (and blank out any of the old wem left over)
+            output.seek(data_start + offset)
+            output.write(new_data + bytes(max(size - len(new_data), 0)))
+            output.seek(didx_start + 0xC * i + 8)
+            output.write(pack('<I', len(new_data)))
+            return True
+
+        if slot_end == data_size:
+            # it is the last wem in DATA so it can just grow into the space after it
+            new_offset = offset
+        else:
+            # put it on the end of the DATA section, 16 byte aligned like everything else
+            new_offset = data_size + align16(data_start + data_size)
+        # everything after the DATA section needs to be moved along
+        output.seek(0, 2)
+        tail = read_at(output, output.tell() - (data_start + data_size), data_start + data_size)
+        output.seek(data_start + min(new_offset, data_size))
+        output.write(bytes(max(new_offset - data_size, 0)))
+        output.write(new_data)
+        output.write(tail)
+        output.truncate()
+        output.seek(data_start - 4)
+        output.write(pack('<I', new_offset + len(new_data)))
+        output.seek(didx_start + 0xC * i + 4)
+        output.write(pack('<II', new_offset, len(new_data)))
+        return False
+
+def merge_banks(paths, output):
+    """ Merge any number of bnks together in one go and write the result to output.
+    The DIDX ids of all the banks are merged together (they are each sorted already), the DATA is laid out once and every wem
+    is copied straight from its original bank into the output. The HIRC sections are all joined one after the other.
+    If an id is in more than one bank, the wem from the later bank is used (same as when adding two BNK_new's).
+    The BKHD (and any other unknown sections) are taken from the first bank.
+    output can be one of the banks being merged: the result is written to a temporary file first and only put in place once
+    all the banks have been closed. """
+    directories = [ChunkDirectory(path_) for path_ in paths]
+    tmp_path = output + '.tmp'
+    try:
+        didxs = []
+        for directory in directories:
+            if 'DIDX' in directory:
+                didx = directory.load('DIDX')
+                didx.sort()
+            else:
+                didx = DIDX(None, added = True)
+            didxs.append(didx)
+
+        # now do a k-way merge of all the ids. Each entry is (id, bank index, index in that banks DIDX)
+        # so when an id appears more than once the one from the latest bank comes last
+        ids = array('I')
+        sizes = array('I')
+        sources = []            # (bank index, location in the bank file) for each wem
+        entries = heapq.merge(*[zip(didx.ids, repeat(bank), range(len(didx.ids))) for bank, didx in enumerate(didxs)])
+        prev = None
+        for entry in entries:
+            if prev is not None and prev[0] != entry[0]:
+                merge_banks_add(prev, didxs, directories, ids, sizes, sources)
+            prev = entry
+        if prev is not None:
+            merge_banks_add(prev, didxs, directories, ids, sizes, sources)
+
+        bkhd = directories[0].load('BKHD')
+        bkhd.sethash(fnvhash(path.splitext(path.basename(output))[0]))
+        start_pos = 8 + len(bkhd) + 8 + 0xC * len(ids) + 8
+        plan = LayoutPlan(ids, sizes, start_pos)
+
+        # the total size and number of entries of the HIRC's
+        num_entries = 0
+        hirc_size = 4
+        hircs = []
+        for directory in directories:
+            if 'HIRC' in directory:
+                offset, size = directory.chunks['HIRC']
+                num_entries += unpack('<I', read_at(directory.input, 4, offset))[0]
+                hirc_size += size - 4
+                hircs.append((directory, offset + 4, size - 4))
+
+        with open(tmp_path, 'wb', buffering = 0) as output_file:
+            write_buffers(output_file, bkhd.getbuffers())
+            didx = plan.getdidx()
+            write_buffers(output_file, [b'DIDX', pack('<I', len(didx)), didx])
+            write_buffers(output_file, [b'DATA', pack('<I', plan.data_size)])
+            for i in range(len(plan)):
+                bank, offset = sources[i]
+                copy_range(directories[bank].input, output_file, offset, plan.sizes[i])
+                write_buffers(output_file, [bytes(plan.padding(i))])
+            write_buffers(output_file, [b'HIRC', pack('<I', hirc_size), pack('<I', num_entries)])
+            for directory, offset, size in hircs:
+                copy_range(directory.input, output_file, offset, size)
+            for tag in directories[0]:
+                if tag not in ('BKHD', 'DIDX', 'DATA', 'HIRC'):
+                    write_buffers(output_file, directories[0].load(tag).getbuffers())
+    except BaseException:
+        for directory in directories:
+            directory.close()
+        if path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    for directory in directories:
+        directory.close()
+    os.replace(tmp_path, output)
+
+def merge_banks_add(entry, didxs, directories, ids, sizes, sources):
+    # add the wem for the merged entry (id, bank index, index in that banks DIDX) to the columns used by merge_banks
+    wem_id, bank, i = entry
+    ids.append(wem_id)
+    sizes.append(didxs[bank].sizes[i])
+    sources.append((bank, directories[bank].chunks['DATA'][0] + didxs[bank].offsets[i]))
+
+def unpack_entries(data):
+    # read the raw DIDX entries in data into the three columns of ids, offsets and sizes
+    entries = array('I')
+    entries.frombytes(data[:len(data) - len(data) % 0xC])
+    if sys.byteorder != 'little':
+        entries.byteswap()
+    return entries[0::3], entries[1::3], entries[2::3]
+
+def pack_entries(ids, offsets, sizes):
+    # the opposite of unpack_entries. Interleave the three columns back into the raw DIDX entries
+    entries = array('I', bytes(0xC * len(ids)))
+    entries[0::3] = array('I', ids)
+    entries[1::3] = array('I', offsets)
+    entries[2::3] = array('I', sizes)
+    if sys.byteorder != 'little':
+        entries.byteswap()
+    return entries.tobytes()
+
+def sorted_unique(ids):
+    # returns the indexes of ids in sorted order, and where an id appears more than once only the last one is kept
+    order = sorted(range(len(ids)), key = ids.__getitem__)      # this is a stable sort so equal ids stay in the order they were in
+    return array('I', (order[i] for i in range(len(order)) if i == len(order) - 1 or ids[order[i]] != ids[order[i + 1]]))
+
+def take(column, order):
+    # returns the values of column in the order of the indexes in order
+    return array(column.typecode, map(column.__getitem__, order))
+
+# the section classes that a bnk chunk tag can be loaded into
+SECTION_TYPES = {'BKHD': BKHD, 'DIDX': DIDX, 'DATA': DATA, 'HIRC': HIRC}
+
 def align16(x):
     # this will take any number and find the number required to be added to make it divisible by 16
     return (16 - (x % 16))%16
@@ -610,7 +1225,4 @@ if __name__ == "__main__":
     #n = HIRC('NMSAP.HIRC')
     #p = h + n
     #p.save('MERGED.HIRC')
-    a = BNK_new(path = 'NMS_AUDIO_PERSISTENT.BNK')
-    b = BNK_new(path = 'scarytest.BNK')
-    c = a+b
-    c.save('newbnk.bnk')
+    merge_banks(['NMS_AUDIO_PERSISTENT.BNK', 'scarytest.BNK'], 'newbnk.bnk')
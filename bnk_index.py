@@ -0,0 +1,162 @@
+# file containing the index cache for bnk files.
+# The chunk table, DIDX and HIRC object table of a bnk are saved into a small binary file so that the bnk doesn't need
+# to be scanned again the next time it is needed, unless it has changed (checked by its size and modification time).
+
+from struct import pack, unpack, unpack_from, calcsize
+from os import path, makedirs, stat, replace
+from collections import OrderedDict as Odict
+from array import array
+import sys
+
+from BNKcompiler import ChunkDirectory, DIDX
+from fnvhash import fnvhash
+
+"""
+.bnkidx file structure (all little endian)
+
++0x000			0x4			char		BNKI		magic
++0x004			0x4			int			-			version
++0x008			0x8			int			-			size of the bnk
++0x010			0x8			int			-			modification time of the bnk (ns)
++0x018			0x4			int			-			number of chunks (N)
+				N x (4s tag, int offset, int size)
+				0x4			int			-			number of DIDX entries (M)
+				M x int ids, M x int offsets, M x int sizes
+				0x4			int			-			number of HIRC objects (H)
+				H x byte types, H x int ids, H x int offsets (absolute location of the object in the bnk)
+"""
+
+INDEX_VERSION = 1
+HEADER = '<4sIQq'
+
+
+class BNKIndex():
+    """ Everything we need to know about where things are in a bnk, without any of the actual data """
+    def __init__(self, chunks, didx, hirc_types = None, hirc_ids = None, hirc_offsets = None):
+        self.chunks = chunks        # ordered dict of tag: (offset, size)
+        self.didx = didx            # DIDX object
+        self.hirc_types = hirc_types if hirc_types is not None else array('B')
+        self.hirc_ids = hirc_ids if hirc_ids is not None else array('I')
+        self.hirc_offsets = hirc_offsets if hirc_offsets is not None else array('I')
+
+    @classmethod
+    def from_bnk(cls, bnk_path):
+        # read the index from the bnk itself
+        with ChunkDirectory(bnk_path) as directory:
+            chunks = Odict(directory.chunks)
+            if 'DIDX' in directory:
+                didx = directory.load('DIDX')
+            else:
+                didx = DIDX(None, added = True)
+            hirc_types = array('B')
+            hirc_ids = array('I')
+            hirc_offsets = array('I')
+            if 'HIRC' in directory:
+                hirc_start = chunks['HIRC'][0]
+                hirc = directory.read('HIRC')
+                # each object is a 1 byte type, 4 byte size, and then the data (which starts with the 4 byte id)
+                pos = 4
+                while pos + 9 <= len(hirc):
+                    obj_type, size, obj_id = unpack_from('<BII', hirc, pos)
+                    hirc_types.append(obj_type)
+                    hirc_ids.append(obj_id)
+                    hirc_offsets.append(hirc_start + pos)
+                    pos += 5 + size
+        return cls(chunks, didx, hirc_types, hirc_ids, hirc_offsets)
+
+    def find(self, wem_id):
+        # returns the (location in the bnk, size) of the wem with the id wem_id
+        offset, size = self.didx.get(int(wem_id))
+        return self.chunks['DATA'][0] + offset, size
+
+    def write(self, index_path, size, mtime):
+        # save the index to index_path. size and mtime are of the bnk so that we can tell if it has changed later
+        data = [pack(HEADER, b'BNKI', INDEX_VERSION, size, mtime), pack('<I', len(self.chunks))]
+        for tag in self.chunks:
+            data.append(pack('<4sII', tag.encode(), *self.chunks[tag]))
+        data.append(pack('<I', len(self.didx.ids)))
+        data += [to_le(self.didx.ids), to_le(self.didx.offsets), to_le(self.didx.sizes)]
+        data.append(pack('<I', len(self.hirc_ids)))
+        data += [self.hirc_types.tobytes(), to_le(self.hirc_ids), to_le(self.hirc_offsets)]
+        # write it to a temporary file first so that a half written index is never read
+        with open(index_path + '.tmp', 'wb') as index_file:
+            index_file.write(b''.join(data))
+        replace(index_path + '.tmp', index_path)
+
+    @classmethod
+    def read(cls, index_path, size, mtime):
+        # load the index from index_path. Returns None if it doesn't exist or isn't for the bnk as it is now
+        try:
+            with open(index_path, 'rb') as index_file:
+                data = index_file.read()
+        except OSError:
+            return None
+        try:
+            magic, version, index_size, index_mtime = unpack_from(HEADER, data, 0)
+            if magic != b'BNKI' or version != INDEX_VERSION or index_size != size or index_mtime != mtime:
+                return None
+            pos = calcsize(HEADER)
+            chunks = Odict()
+            num_chunks = unpack_from('<I', data, pos)[0]
+            pos += 4
+            for i in range(num_chunks):
+                tag, offset, chunk_size = unpack_from('<4sII', data, pos)
+                chunks[tag.decode()] = (offset, chunk_size)
+                pos += 0xC
+            num_entries = unpack_from('<I', data, pos)[0]
+            pos += 4
+            ids, pos = from_le(data, pos, 'I', num_entries)
+            offsets, pos = from_le(data, pos, 'I', num_entries)
+            sizes, pos = from_le(data, pos, 'I', num_entries)
+            num_hircs = unpack_from('<I', data, pos)[0]
+            pos += 4
+            hirc_types, pos = from_le(data, pos, 'B', num_hircs)
+            hirc_ids, pos = from_le(data, pos, 'I', num_hircs)
+            hirc_offsets, pos = from_le(data, pos, 'I', num_hircs)
+        except Exception:
+            # anything wrong with the file just means that it is rebuilt
+            return None
+        didx = DIDX(None, ids = ids, offsets = offsets, sizes = sizes, added = True)
+        return cls(chunks, didx, hirc_types, hirc_ids, hirc_offsets)
+
+
+def index_path(bnk_path, cache_dir = None):
+    # where the index of the bnk is stored. Either next to the bnk, or in cache_dir under a name made from the bnk's full path
+    if cache_dir is None:
+        return '{}.bnkidx'.format(bnk_path)
+    return path.join(cache_dir, '{0}_{1:08X}.bnkidx'.format(path.splitext(path.basename(bnk_path))[0], fnvhash(path.abspath(bnk_path))))
+
+def load_index(bnk_path, cache_dir = None):
+    """ Returns the BNKIndex of the bnk at bnk_path.
+    If there is a cached one that is still valid it is used, otherwise the bnk is read and the result is cached. """
+    info = stat(bnk_path)
+    idx_path = index_path(bnk_path, cache_dir)
+    index = BNKIndex.read(idx_path, info.st_size, info.st_mtime_ns)
+    if index is None:
+        index = BNKIndex.from_bnk(bnk_path)
+        try:
+            if cache_dir is not None and not path.exists(cache_dir):
+                makedirs(cache_dir)
+            index.write(idx_path, info.st_size, info.st_mtime_ns)
+        except OSError:
+            # couldn't write the cache (eg. read only folder). Not a problem, it will just be read from the bnk again next time
+            pass
+    return index
+
+def to_le(column):
+    # the raw little endian bytes of an array
+    if sys.byteorder != 'little':
+        column = array(column.typecode, column)
+        column.byteswap()
+    return column.tobytes()
+
+def from_le(data, pos, typecode, count):
+    # read count values of type typecode from data at pos. Returns the array and the position after it
+    column = array(typecode)
+    end = pos + column.itemsize * count
+    if end > len(data):
+        raise ValueError('index file is too short')
+    column.frombytes(data[pos:end])
+    if sys.byteorder != 'little':
+        column.byteswap()
+    return column, end
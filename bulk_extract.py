@@ -0,0 +1,78 @@
+# file containing the functions to extract every soundbank in the game at once.
+# Each bank is extracted in its own process so that they can all be done at the same time on however many cores there are.
+
+from os import path, cpu_count
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from BNKcompiler import BNK
+from catalog import read_soundbanks
+
+# soundbanks that don't have anything worth extracting
+SKIPPED_SOUNDBANKS = ["Init", "ConvVerb_Impulses"]
+
+
+def list_soundbanks(audio_path, names = None):
+    """ Returns a list of (name, path of the bnk) for each of the soundbanks in the SOUNDBANKSINFO.XML in audio_path.
+    The names are the same as shown in the GUI (so the Vocal_Localised banks have their language on the end).
+    If names is given, only the soundbanks with those names are returned. """
+    soundbanks = []
+    for sb in read_soundbanks(path.join(audio_path, 'SOUNDBANKSINFO.XML')):
+        if sb.short_name in SKIPPED_SOUNDBANKS:
+            continue
+        name = sb.display_name
+        sb_path = sb.path.upper()
+        if names is None or name in names:
+            soundbanks.append((name, path.join(audio_path, sb_path)))
+    return soundbanks
+
+def extract_bank(name, bnk_path, output_path, speedmode = False):
+    """ Extract a single soundbank. This is what is run in each of the worker processes.
+    The wems are read from the bnk one at a time so the memory used is only ever about the size of the biggest one.
+    Returns (name, number of wems, error message or None) """
+    if not path.exists(bnk_path):
+        return (name, 0, 'No bnk at {}'.format(bnk_path))
+    try:
+        b = BNK(name.upper(), bnk_path, output_path)
+        # only the wems that have changed since the last time the game was extracted need to be written
+        b.extract(speedmode = speedmode, incremental = True)
+        num_wems = len(b.didx.ids) if hasattr(b, 'didx') else 0
+        return (name, num_wems, None)
+    except Exception as e:
+        return (name, 0, '{0}: {1}'.format(type(e).__name__, e))
+
+def extract_all(audio_path, working_path, names = None, workers = None, progress = None, speedmode = False):
+    """ Extract all the soundbanks listed in the SOUNDBANKSINFO.XML in audio_path (or just the ones in names) into working_path.
+    Each bank goes into working_path/<NAME> just like when it is unpacked in the GUI.
+    - workers:
+      Number of processes to use. Defaults to the number of cores.
+    - progress:
+      Function that is called as progress(banks done, total banks, total wems extracted, name of the bank just done)
+      each time a bank finishes.
+    Returns a dictionary of name: error message for any banks that failed. """
+    soundbanks = list_soundbanks(audio_path, names)
+    if workers is None:
+        workers = cpu_count() or 1
+    errors = dict()
+    done = 0
+    total_wems = 0
+    with ProcessPoolExecutor(max_workers = workers) as pool:
+        jobs = [pool.submit(extract_bank, name, bnk_path, path.join(working_path, name.upper()), speedmode)
+                for name, bnk_path in soundbanks]
+        for job in as_completed(jobs):
+            name, num_wems, error = job.result()
+            done += 1
+            total_wems += num_wems
+            if error is not None:
+                errors[name] = error
+            if progress is not None:
+                progress(done, len(soundbanks), total_wems, name)
+    return errors
+
+
+if __name__ == '__main__':
+    import sys
+    def print_progress(done, total, num_wems, name):
+        print('[{0}/{1}] {2} ({3} wems so far)'.format(done, total, name, num_wems))
+    errors = extract_all(sys.argv[1], sys.argv[2], names = sys.argv[3:] or None, progress = print_progress)
+    for name in errors:
+        print('Failed to extract {0}: {1}'.format(name, errors[name]))
@@ -0,0 +1,375 @@
+# file containing the catalog of the soundbanks in the game (ie. what is in the SOUNDBANKSINFO.XML, and each bank's own xml).
+# The xml is compiled into a small sqlite database the first time it is read, so that next time it can be loaded straight
+# from there. Each xml file is only parsed again if its size or modification time has changed (ie. after a game update).
+# Everything is also indexed once when it is loaded so that finding a soundbank is just a dictionary lookup.
+
+from os import stat, path, remove
+from collections import OrderedDict as Odict
+import xml.etree.ElementTree as ET
+import threading
+
+# without sqlite everything still works, the xml just gets parsed every time
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+
+from fnvhash import fnvhash_batch, cached_fnvhash
+
+LOCALISED_BANK = 'Vocal_Localised'      # the only soundbank that has a copy per language
+CATALOG_VERSION = 1
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS sources (path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER);
+CREATE TABLE IF NOT EXISTS soundbanks (key INTEGER PRIMARY KEY, id TEXT, language TEXT, short_name TEXT, path TEXT, xml_path TEXT);
+CREATE TABLE IF NOT EXISTS audio (source TEXT, soundbank INTEGER, kind TEXT, position INTEGER, name TEXT, id TEXT);
+CREATE INDEX IF NOT EXISTS audio_soundbank ON audio (soundbank, kind);
+CREATE INDEX IF NOT EXISTS audio_source ON audio (source);
+"""
+
+# the search index. The trigram tokenizer lets fts5 find any part of a name, not just whole words
+SEARCH_SCHEMA = "CREATE VIRTUAL TABLE IF NOT EXISTS search USING fts5(name, id, bank, language, kind UNINDEXED, path UNINDEXED, tokenize = 'trigram')"
+# if the sqlite doesn't have fts5 (or the trigram tokenizer) a normal table is searched instead
+SEARCH_FALLBACK_SCHEMA = "CREATE TABLE IF NOT EXISTS search (name TEXT, id TEXT, bank TEXT, language TEXT, kind TEXT, path TEXT)"
+SEARCH_LIMIT = 500
+
+
+def display_name(soundbank):
+    # the name of the soundbank as shown in the GUI. The localised banks have the language they are for on the end
+    name = soundbank.short_name
+    if name == LOCALISED_BANK:
+        region = soundbank.path.split('\\')[0]
+        name = '{0}_[{1}]'.format(name, region)
+    return name
+
+def split_name(name):
+    # the opposite of display_name. Returns (short name, language), with the language being None if it isn't a localised bank
+    if name.startswith(LOCALISED_BANK):
+        return LOCALISED_BANK, name[len(LOCALISED_BANK) + 2 : -1]
+    return name, None
+
+
+class AudioRows():
+    """ The (name, id) rows of a list of audio files (or events), ready to be shown in the GUI and searched """
+    def __init__(self, names, ids):
+        self.names = names
+        self.ids = ids
+        # what the search term is looked for in. The \0 stops a search matching across the end of the name and start of the id
+        self.keys = ['{0}\0{1}'.format(name, Id).upper() for name, Id in zip(names, ids)]
+
+    def __len__(self):
+        return len(self.names)
+
+    def __iter__(self):
+        return zip(self.names, self.ids)
+
+    def filter(self, compare = ''):
+        # returns the (name, id) of each row whose name or id contains compare (ignoring case)
+        if compare == '':
+            return list(zip(self.names, self.ids))
+        compare = compare.upper()
+        return [(self.names[i], self.ids[i]) for i, key in enumerate(self.keys) if compare in key]
+
+
+class SoundBankRecord():
+    """ What we know about a soundbank from the SOUNDBANKSINFO.XML.
+    This is used instead of the xml element itself so that it can be loaded from the catalog without parsing any xml.
+    The events, included files and streamed files are AudioRows. If the record came from the catalog they are only
+    loaded from it the first time they are needed. """
+    def __init__(self, Id, language, short_name, path, events = None, included = None, streamed = None, catalog = None, key = None):
+        self.id = Id
+        self.language = language
+        self.short_name = short_name
+        self.path = path
+        self.catalog = catalog
+        self.key = key          # the key of the soundbank in the catalog
+        self._rows = {'event': events, 'included': included, 'streamed': streamed}
+
+    @classmethod
+    def from_element(cls, sb):
+        # make the record from a SoundBank element of a SoundbanksInfo.xml
+        return cls(sb.attrib['Id'], sb.attrib.get('Language'), sb.find('ShortName').text, sb.find('Path').text,
+                   events = element_rows(sb, 'IncludedEvents', 'Event'),
+                   included = element_rows(sb, 'IncludedMemoryFiles', 'File'),
+                   streamed = element_rows(sb, 'ReferencedStreamedFiles', 'File'))
+
+    @property
+    def display_name(self):
+        return display_name(self)
+
+    def rows(self, kind):
+        if self._rows[kind] is None:
+            self._rows[kind] = self.catalog.rows(self.key, kind)
+        return self._rows[kind]
+
+    @property
+    def events(self):
+        return self.rows('event')
+
+    @property
+    def included(self):
+        return self.rows('included')
+
+    @property
+    def streamed(self):
+        # the streamed files listed in the SOUNDBANKSINFO.XML. These don't have names, they are only in the bank's own xml
+        return self.rows('streamed')
+
+
+def element_rows(element, group, tag):
+    # the AudioRows of all the tag elements in the group element of element (events have a Name, files have a ShortName)
+    names = []
+    ids = []
+    group_element = element.find(group)
+    if group_element is not None:
+        for child in group_element.findall(tag):
+            names.append(child.attrib['Name'] if 'Name' in child.attrib else child.findtext('ShortName', ''))
+            ids.append(child.attrib['Id'])
+    return AudioRows(names, ids)
+
+def read_soundbanks(xml_path):
+    # read the SoundBankRecord of every soundbank in a SoundbanksInfo.xml
+    tree = ET.ElementTree()
+    tree.parse(xml_path)
+    return [SoundBankRecord.from_element(sb) for sb in tree.find('SoundBanks').iter("SoundBank")]
+
+def read_streamed_rows(xml_path):
+    # read the streamed files listed in a bank's own xml (the names of these aren't in the SOUNDBANKSINFO.XML)
+    tree = ET.ElementTree()
+    tree.parse(xml_path)
+    return element_rows(tree.find('SoundBanks').find("SoundBank"), 'ReferencedStreamedFiles', 'File')
+
+def bank_xml_path(audio_path, sb_path):
+    # the path of the bank's own xml from the path of its bnk
+    return path.join(audio_path, '{}.XML'.format(path.splitext(sb_path.upper())[0]))
+
+
+class Catalog():
+    """ The soundbanks in the SOUNDBANKSINFO.XML in audio_path, compiled into a database at db_path.
+    self.soundbanks is the list of SoundBankRecords, in the same order as the xml. """
+    def __init__(self, db_path, audio_path):
+        self.db_path = db_path
+        self.audio_path = audio_path
+        self.info_path = path.abspath(path.join(audio_path, 'SOUNDBANKSINFO.XML'))
+        # the records are used from the threads the gui starts too, so the database can be too
+        self.lock = threading.RLock()
+        self.db = None
+        if sqlite3 is not None:
+            try:
+                self.open()
+            except sqlite3.DatabaseError:
+                # the database is broken somehow, so just start again
+                if self.db is not None:
+                    self.db.close()
+                remove(self.db_path)
+                self.open()
+        self.soundbanks = self.load()
+
+    def open(self):
+        self.db = sqlite3.connect(self.db_path, check_same_thread = False)
+        version = None
+        if self.db.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'meta'").fetchone() is not None:
+            version = self.db.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+        if version is None or version[0] != str(CATALOG_VERSION):
+            # made by a different version of this, so everything in it needs to be compiled again
+            with self.db:
+                for table in ('meta', 'sources', 'soundbanks', 'audio', 'search'):
+                    self.db.execute("DROP TABLE IF EXISTS {}".format(table))
+        with self.db:
+            self.db.executescript(SCHEMA)
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES ('version', ?)", (str(CATALOG_VERSION),))
+        try:
+            with self.db:
+                self.db.execute(SEARCH_SCHEMA)
+            self.fts = True
+        except sqlite3.OperationalError:
+            with self.db:
+                self.db.execute(SEARCH_FALLBACK_SCHEMA)
+            self.fts = False
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+    def is_fresh(self, file_path):
+        # whether the file has been compiled into the catalog and not changed since. Returns (fresh, (size, mtime) of the file)
+        info = stat(file_path)
+        file_stat = (info.st_size, info.st_mtime_ns)
+        row = self.db.execute("SELECT size, mtime FROM sources WHERE path = ?", (file_path,)).fetchone()
+        return row is not None and tuple(row) == file_stat, file_stat
+
+    def load(self):
+        if self.db is None:
+            return read_soundbanks(self.info_path)
+        with self.lock:
+            fresh, info_stat = self.is_fresh(self.info_path)
+            if not fresh:
+                self.compile_info(info_stat)
+            soundbanks = self.db.execute("SELECT key, id, language, short_name, path FROM soundbanks ORDER BY key").fetchall()
+        return [SoundBankRecord(Id, language, short_name, sb_path, catalog = self, key = key)
+                for key, Id, language, short_name, sb_path in soundbanks]
+
+    def compile_info(self, info_stat):
+        # parse the SOUNDBANKSINFO.XML and put everything in it into the catalog
+        print('Compiling {} into the catalog'.format(self.info_path))
+        soundbanks = read_soundbanks(self.info_path)
+        with self.db:
+            self.db.execute("DELETE FROM soundbanks")
+            self.db.execute("DELETE FROM audio WHERE source = ?", (self.info_path,))
+            for key, sb in enumerate(soundbanks):
+                self.db.execute("INSERT INTO soundbanks VALUES (?, ?, ?, ?, ?, ?)",
+                                (key, sb.id, sb.language, sb.short_name, sb.path, path.abspath(bank_xml_path(self.audio_path, sb.path))))
+                for kind in ('event', 'included', 'streamed'):
+                    self.insert_rows(self.info_path, key, kind, sb.rows(kind))
+            self.db.execute("INSERT OR REPLACE INTO sources VALUES (?, ?, ?)", (self.info_path,) + info_stat)
+            self.db.execute("DELETE FROM meta WHERE key = 'search'")
+
+    def insert_rows(self, source, key, kind, rows):
+        self.db.executemany("INSERT INTO audio VALUES (?, ?, ?, ?, ?, ?)",
+                            ((source, key, kind, position, name, Id) for position, (name, Id) in enumerate(rows)))
+
+    def rows(self, key, kind):
+        # the AudioRows of one kind of thing in a soundbank (from the SOUNDBANKSINFO.XML)
+        with self.lock:
+            found = self.db.execute("SELECT name, id FROM audio WHERE soundbank = ? AND kind = ? ORDER BY position", (key, kind)).fetchall()
+        return AudioRows([row[0] for row in found], [row[1] for row in found])
+
+    def streamed_rows(self, xml_path):
+        """ Returns the AudioRows of the streamed files in a bank's own xml. The xml is only parsed if it has changed since it was
+        last compiled into the catalog. """
+        if self.db is None:
+            return read_streamed_rows(xml_path)
+        xml_path = path.abspath(xml_path)
+        rows = self.compile_bank(xml_path)
+        if rows is None:
+            with self.lock:
+                found = self.db.execute("SELECT name, id FROM audio WHERE source = ? ORDER BY position", (xml_path,)).fetchall()
+            rows = AudioRows([row[0] for row in found], [row[1] for row in found])
+        return rows
+
+    def compile_bank(self, xml_path):
+        """ Compile a bank's own xml into the catalog if it has changed. Returns its AudioRows if it was read, or None if it hadn't changed.
+        The xml is parsed without holding the lock, so that the gui can still use the catalog while the search index is being built """
+        with self.lock:
+            fresh, xml_stat = self.is_fresh(xml_path)
+        if fresh:
+            return None
+        rows = read_streamed_rows(xml_path)
+        with self.lock:
+            with self.db:
+                self.db.execute("DELETE FROM audio WHERE source = ?", (xml_path,))
+                self.insert_rows(xml_path, None, 'bank_streamed', rows)
+                self.db.execute("INSERT OR REPLACE INTO sources VALUES (?, ?, ?)", (xml_path,) + xml_stat)
+                self.db.execute("DELETE FROM meta WHERE key = 'search'")
+        return rows
+
+    def refresh_search(self):
+        """ Make sure the search index is up to date. Every bank's own xml needs to be in the catalog for this, so the first time
+        this is run it can take a while. After that only the xml files that have changed are read again. """
+        if self.db is None:
+            return
+        # each bank only holds the lock while it is being written to the catalog
+        for sb in self.soundbanks:
+            xml_path = path.abspath(bank_xml_path(self.audio_path, sb.path))
+            if path.exists(xml_path):
+                self.compile_bank(xml_path)
+        with self.lock:
+            if self.db.execute("SELECT value FROM meta WHERE key = 'search'").fetchone() is not None:
+                return
+            print('Building the search index')
+            with self.db:
+                self.db.execute("DELETE FROM search")
+                # everything from the SOUNDBANKSINFO.XML, apart from the streamed files as they only have names in the bank's own xml
+                self.db.execute("""INSERT INTO search (name, id, bank, language, kind, path)
+                                   SELECT audio.name, audio.id, soundbanks.short_name, soundbanks.language, audio.kind, soundbanks.path
+                                   FROM audio JOIN soundbanks ON audio.soundbank = soundbanks.key WHERE audio.kind != 'streamed'""")
+                self.db.execute("""INSERT INTO search (name, id, bank, language, kind, path)
+                                   SELECT audio.name, audio.id, soundbanks.short_name, soundbanks.language, 'streamed', soundbanks.path
+                                   FROM audio JOIN soundbanks ON audio.source = soundbanks.xml_path WHERE audio.kind = 'bank_streamed'""")
+                self.db.execute("INSERT OR REPLACE INTO meta VALUES ('search', '1')")
+
+    def search(self, term, limit = SEARCH_LIMIT):
+        """ Find every event, included file and streamed file in any bank whose name, id, bank or language contains term.
+        Returns a list of (bank name as shown in the GUI, kind ('event', 'included' or 'streamed'), name, id).
+        refresh_search needs to have been run first. """
+        if self.db is None or term == '':
+            return []
+        columns = "SELECT bank, path, kind, name, id FROM search"
+        with self.lock:
+            if self.fts and len(term) >= 3:
+                # the term is quoted so that fts5 looks for it exactly (a quote in it is escaped by doubling it)
+                found = self.db.execute(columns + " WHERE search MATCH ? LIMIT ?", ('"{}"'.format(term.replace('"', '""')), limit)).fetchall()
+            else:
+                # too short for the trigram index (or there isn't one), so just check every row
+                pattern = '%{}%'.format(term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_'))
+                found = self.db.execute(columns + " WHERE name LIKE ?1 ESCAPE '\\' OR id LIKE ?1 ESCAPE '\\' OR bank LIKE ?1 ESCAPE '\\'"
+                                        " OR language LIKE ?1 ESCAPE '\\' LIMIT ?2", (pattern, limit)).fetchall()
+        return [(display_name(SoundBankRecord(None, None, bank, sb_path)), kind, name, Id) for bank, sb_path, kind, name, Id in found]
+
+
+class SoundBankIndex():
+    """ Index of the SoundBankRecords by id and language, short name and path """
+    def __init__(self, soundbanks):
+        self.soundbanks = list(soundbanks)
+        self.by_id = dict()             # (Id, Language): soundbank
+        self.first_by_id = dict()       # Id: the first soundbank with that id (whatever its language)
+        self.by_name = dict()           # ShortName: the first soundbank with that name
+        self.by_path = dict()           # upper case Path: soundbank
+        short_names = [sb.short_name for sb in self.soundbanks]
+        # the hash of each name is the id of its soundbank, so if we know all the names we never need to hash them again
+        self.hashes = dict(zip(short_names, (str(h) for h in fnvhash_batch(short_names))))
+        for sb in self.soundbanks:
+            self.by_id.setdefault((sb.id, sb.language), sb)
+            self.first_by_id.setdefault(sb.id, sb)
+            self.by_name.setdefault(sb.short_name, sb)
+            self.by_path[sb.path.upper()] = sb
+
+    def __iter__(self):
+        return iter(self.soundbanks)
+
+    def __len__(self):
+        return len(self.soundbanks)
+
+    def hash(self, short_name):
+        # the id of the soundbank called short_name (as a string like in the xml)
+        Id = self.hashes.get(short_name)
+        if Id is None:
+            Id = str(cached_fnvhash(short_name))
+        return Id
+
+    def find(self, name):
+        """ Returns the soundbank with the name shown in the GUI (so Vocal_Localised_[language] for the localised ones), or None """
+        short_name, language = split_name(name)
+        if language is None:
+            return self.first_by_id.get(self.hash(short_name))
+        return self.by_id.get((self.hash(short_name), language))
+
+    def find_path(self, sb_path):
+        # returns the soundbank whose bnk is at sb_path (relative to the AUDIO folder), or None
+        return self.by_path.get(sb_path.upper())
+
+
+class StreamedRowsCache():
+    """ Keeps the streamed file rows of the most recently used banks so their xml doesn't need to be parsed every time the list
+    is shown or searched. A bank's rows are read again if its xml has changed since (going by its size and modification time).
+    - loader:
+      Function that reads the rows from the xml path. By default the xml is parsed, but Catalog.streamed_rows can be used instead. """
+    def __init__(self, maxsize = 16, loader = read_streamed_rows):
+        self.maxsize = maxsize
+        self.loader = loader
+        self.entries = Odict()      # xml path: (size, modification time, AudioRows), least recently used first
+
+    def get(self, xml_path):
+        info = stat(xml_path)
+        entry = self.entries.get(xml_path)
+        if entry is not None and entry[:2] == (info.st_size, info.st_mtime_ns):
+            self.entries.move_to_end(xml_path)
+            return entry[2]
+        rows = self.loader(xml_path)
+        self.entries[xml_path] = (info.st_size, info.st_mtime_ns, rows)
+        self.entries.move_to_end(xml_path)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last = False)
+        return rows
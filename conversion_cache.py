@@ -0,0 +1,113 @@
+# file containing the cache of converted files (oggs, wavs...).
+# Each one is kept under a hash of the wem it was made from and of the backend used to make it, so any wem that has been
+# converted before (even with a different id, or from a different bank or version of the game) doesn't need converting again.
+# The cache has a maximum size, and when it goes over that the files that were used least recently are removed.
+
+from os import path, makedirs, remove, replace, listdir
+from collections import OrderedDict
+from hashlib import blake2b
+import threading
+import pickle
+
+from wem_store import WEMStore, link_or_copy
+
+CACHE_VERSION = 2
+
+
+class ConversionCache():
+    """ Converted files, keyed by the hash of their wem and the version of the backend that converted them.
+    - root:
+      Folder the files and the manifest are kept in.
+    - max_size:
+      Most bytes of converted files to keep. Once there are more than this the least recently used ones are removed.
+    Can be used from any thread. save() needs to be called to keep any changes for next time. """
+    def __init__(self, root, max_size = 0x80000000):
+        self.root = root
+        self.max_size = max_size
+        if not path.exists(self.root):
+            makedirs(self.root)
+        self.manifest_path = path.join(self.root, 'manifest.pkl')
+        self.lock = threading.RLock()
+        self.entries = OrderedDict()     # key: size of the file, least recently used first
+        try:
+            with open(self.manifest_path, 'rb') as f:
+                manifest = pickle.load(f)
+            if manifest['version'] == CACHE_VERSION:
+                self.entries = manifest['entries']
+        except Exception:
+            pass
+        self.size = sum(self.entries.values())
+
+    def cached_path(self, key):
+        # files are stored under their key alone, the extension they had is already part of the backend's version
+        return path.join(self.root, key[:2], '{}.cached'.format(key))
+
+    def key(self, wem_path, version):
+        # the key of the file that the wem would be converted to by the backend with version
+        hash_ = blake2b(digest_size = 16)
+        hash_.update(WEMStore.hash_file(wem_path).encode())
+        hash_.update(version.encode())
+        return hash_.hexdigest()
+
+    def fetch(self, key, dest):
+        """ If the file with key is in the cache put it at dest and return True, otherwise return False """
+        with self.lock:
+            if key not in self.entries:
+                return False
+            self.entries.move_to_end(key)
+        try:
+            if path.exists(dest):
+                remove(dest)
+            link_or_copy(self.cached_path(key), dest)
+            return True
+        except OSError:
+            # it has been removed from the folder by something else
+            with self.lock:
+                self.forget(key)
+            return False
+
+    def add(self, key, file_path):
+        # keep the converted file at file_path in the cache under key. file_path must not be written to after this
+        cached_path = self.cached_path(key)
+        if not path.exists(path.dirname(cached_path)):
+            makedirs(path.dirname(cached_path), exist_ok = True)
+        tmp_path = '{0}.{1}.tmp'.format(cached_path, threading.get_ident())
+        link_or_copy(file_path, tmp_path)
+        replace(tmp_path, cached_path)
+        with self.lock:
+            self.forget(key)
+            self.entries[key] = path.getsize(cached_path)
+            self.size += self.entries[key]
+            self.evict()
+
+    def forget(self, key):
+        size = self.entries.pop(key, None)
+        if size is not None:
+            self.size -= size
+
+    def evict(self):
+        # remove the least recently used files until the cache is back under its size
+        with self.lock:
+            while self.size > self.max_size and len(self.entries) != 0:
+                key = next(iter(self.entries))
+                self.forget(key)
+                if path.exists(self.cached_path(key)):
+                    remove(self.cached_path(key))
+
+    def clean(self):
+        # remove any files in the folder that aren't in the manifest (eg. left over from something that crashed)
+        with self.lock:
+            for folder in listdir(self.root):
+                if not path.isdir(path.join(self.root, folder)):
+                    continue
+                for file in listdir(path.join(self.root, folder)):
+                    key, ext = path.splitext(file)
+                    if ext != '.cached' or key not in self.entries:
+                        remove(path.join(self.root, folder, file))
+
+    def save(self):
+        # save the manifest
+        with self.lock:
+            with open(self.manifest_path + '.tmp', 'wb') as f:
+                pickle.dump({'version': CACHE_VERSION, 'entries': self.entries}, f)
+            replace(self.manifest_path + '.tmp', self.manifest_path)
@@ -0,0 +1,382 @@
+# file containing the conversion of wems into something that can be played.
+# How a wem is converted is up to a backend: the ww2ogg and revorb tools (ToolBackend), any other program (CommandBackend),
+# or for wems that are just PCM, rewriting them as a wav right here without running anything (PCMBackend).
+# Converter runs lots of conversions at once on a pool of threads
+# (the tools run in their own processes, so threads are enough to keep all the cores busy).
+
+from os import path, cpu_count, remove
+from queue import PriorityQueue, Queue, Empty
+from itertools import count
+from hashlib import blake2b
+import subprocess
+import threading
+import struct
+import shlex
+import os
+
+# stops a console window popping up for each conversion on windows
+CREATION_FLAGS = getattr(subprocess, 'CREATE_NO_WINDOW', 0)
+OUTPUT_EXTENSIONS = ('.ogg', '.wav')        # the kinds of file a wem can be converted to (and that can be played back)
+STAGES = 2          # number of steps of a conversion that can be running on different files at once
+
+WAVE_FORMAT_PCM = 0x0001
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE     # the real format is then at the start of the sub format guid
+HEADER_SIZE = 0x1000                # the fmt chunk is always well within this much of the start of a wem
+
+
+def ww2ogg_args(tool_path, wem_path):
+    return [ww2ogg_exe(tool_path), wem_path, '--pcb', codebooks_path(tool_path)]
+
+def revorb_args(tool_path, ogg_path):
+    return [revorb_exe(tool_path), ogg_path]
+
+def ww2ogg_exe(tool_path):
+    return path.join(tool_path, 'ww2ogg', 'ww2ogg.exe')
+
+def codebooks_path(tool_path):
+    return path.join(tool_path, 'ww2ogg', 'packed_codebooks_aoTuV_603.bin')
+
+def revorb_exe(tool_path):
+    return path.join(tool_path, 'revorb', 'revorb.exe')
+
+def ogg_path(wem_path):
+    # ww2ogg puts the ogg next to the wem
+    return output_path(wem_path, '.ogg')
+
+def output_path(wem_path, extension):
+    return '{0}{1}'.format(path.splitext(wem_path)[0], extension)
+
+def find_output(wem_path):
+    # the converted file of the wem (whatever it was converted to), or None if it hasn't been converted
+    for extension in OUTPUT_EXTENSIONS:
+        if path.exists(output_path(wem_path, extension)):
+            return output_path(wem_path, extension)
+    return None
+
+def run_tool(args):
+    # run one of the tools, raising an error if it fails
+    code = subprocess.call(args = args, creationflags = CREATION_FLAGS)
+    if code != 0:
+        raise RuntimeError('{0} failed with exit code {1}'.format(path.basename(args[0]), code))
+
+def convert_wem(tool_path, wem_path):
+    """ Convert a single wem to an ogg (in the same folder) and return the path of the ogg. """
+    run_tool(ww2ogg_args(tool_path, wem_path))
+    run_tool(revorb_args(tool_path, ogg_path(wem_path)))
+    return ogg_path(wem_path)
+
+def hash_files(files):
+    # hash of the contents of all the files (any that don't exist are just skipped)
+    hash_ = blake2b(digest_size = 16)
+    for file_path in files:
+        hash_.update(path.basename(file_path).encode())
+        if path.exists(file_path):
+            with open(file_path, 'rb') as f:
+                for block in iter(lambda: f.read(0x100000), b''):
+                    hash_.update(block)
+    return hash_.hexdigest()
+
+
+def riff_chunks(data):
+    # yields (chunk id, chunk data) for each chunk of the RIFF file data. Stops at the end of data even if that is partway through a chunk
+    if data[:4] != b'RIFF' or data[8:12] != b'WAVE':
+        return
+    offset = 12
+    while offset + 8 <= len(data):
+        chunk_id, size = struct.unpack_from('<4sI', data, offset)
+        yield chunk_id, data[offset + 8:offset + 8 + size]
+        # chunks always start on an even byte
+        offset += 8 + size + (size & 1)
+
+def find_chunk(data, chunk_id):
+    for id_, chunk in riff_chunks(data):
+        if id_ == chunk_id:
+            return chunk
+    return None
+
+def format_tag(fmt):
+    # the audio format in the fmt chunk of a wem
+    if len(fmt) < 2:
+        return None
+    tag = struct.unpack_from('<H', fmt)[0]
+    if tag == WAVE_FORMAT_EXTENSIBLE and len(fmt) >= 26:
+        tag = struct.unpack_from('<H', fmt, 24)[0]
+    return tag
+
+def is_pcm_wem(wem_path):
+    with open(wem_path, 'rb') as f:
+        fmt = find_chunk(f.read(HEADER_SIZE), b'fmt ')
+    return fmt is not None and format_tag(fmt) == WAVE_FORMAT_PCM
+
+def pcm_wem_to_wav(wem_path, wav_path):
+    """ Rewrite a PCM wem as a plain wav. The samples are just copied over, only the header is changed
+    (the wwise specific chunks are dropped and the fmt chunk is written in its simplest form). """
+    with open(wem_path, 'rb') as f:
+        data = f.read()
+    fmt = find_chunk(data, b'fmt ')
+    samples = find_chunk(data, b'data')
+    if fmt is None or samples is None or len(fmt) < 16 or format_tag(fmt) != WAVE_FORMAT_PCM:
+        raise ValueError('{} is not a PCM wem'.format(path.basename(wem_path)))
+    channels, rate = struct.unpack_from('<HI', fmt, 2)
+    bits = struct.unpack_from('<H', fmt, 14)[0]
+    block_align = channels * bits // 8
+    header = struct.pack('<4sI4s4sIHHIIHH4sI', b'RIFF', 36 + len(samples), b'WAVE',
+                         b'fmt ', 16, WAVE_FORMAT_PCM, channels, rate, rate * block_align, block_align, bits,
+                         b'data', len(samples))
+    with open(wav_path, 'wb') as f:
+        f.write(header)
+        f.write(samples)
+
+
+class ConverterBackend():
+    """ A way of converting wems. Each backend has:
+    - name:
+      What it is called in the settings.
+    - extension:
+      Extension of the files it makes (one of OUTPUT_EXTENSIONS to be able to play them).
+    - version:
+      Changes whenever the files it makes would be different (eg. the tools are updated), so the ConversionCache knows.
+    - steps:
+      Functions that are each called with the path of the wem, in order, to convert it. Only the first STAGES are run as
+      separate stages, any after that are run along with the last one.
+    - external:
+      True if the steps run other programs (these are the ones limited by the Converter's workers). """
+    name = None
+    extension = '.ogg'
+    version = ''
+    external = True
+
+    def __init__(self):
+        self.steps = []
+
+    def output_path(self, wem_path):
+        return output_path(wem_path, self.extension)
+
+    def accepts(self, wem_path):
+        # whether this backend can convert the wem
+        return True
+
+
+class ToolBackend(ConverterBackend):
+    """ Converts to ogg with ww2ogg then revorb """
+    name = 'tools'
+
+    def __init__(self, tool_path):
+        super(ToolBackend, self).__init__()
+        self.tool_path = tool_path
+        self.version = 'tools ' + hash_files([ww2ogg_exe(tool_path), codebooks_path(tool_path), revorb_exe(tool_path)])
+        self.steps = [self.ww2ogg, self.revorb]
+
+    def ww2ogg(self, wem_path):
+        run_tool(ww2ogg_args(self.tool_path, wem_path))
+
+    def revorb(self, wem_path):
+        run_tool(revorb_args(self.tool_path, ogg_path(wem_path)))
+
+
+class CommandBackend(ConverterBackend):
+    """ Converts with any program. command is the command line to run, with {input} where the path of the wem goes
+    and {output} where the path of the file it should make goes, eg. 'vgmstream-cli -o "{output}" "{input}"' """
+    name = 'command'
+
+    def __init__(self, command, extension = '.wav'):
+        super(CommandBackend, self).__init__()
+        self.command = command
+        self.extension = extension
+        self.version = 'command {0} {1}'.format(command, extension)
+        self.steps = [self.run]
+
+    def args(self, wem_path):
+        if os.name == 'nt':
+            # posix splitting would take the backslashes in the paths as escapes
+            args = [arg.strip('"') for arg in shlex.split(self.command, posix = False)]
+        else:
+            args = shlex.split(self.command)
+        return [arg.format(input = wem_path, output = self.output_path(wem_path)) for arg in args]
+
+    def run(self, wem_path):
+        run_tool(self.args(wem_path))
+
+
+class PCMBackend(ConverterBackend):
+    """ Rewrites PCM wems as wavs, in this process. Can only convert wems that are PCM """
+    name = 'pcm'
+    extension = '.wav'
+    version = 'pcm 1'
+    external = False
+
+    def __init__(self):
+        super(PCMBackend, self).__init__()
+        self.steps = [self.rewrap]
+
+    def accepts(self, wem_path):
+        try:
+            return is_pcm_wem(wem_path)
+        except OSError:
+            return False
+
+    def rewrap(self, wem_path):
+        pcm_wem_to_wav(wem_path, self.output_path(wem_path))
+
+
+class ConversionJob():
+    """ A wem that has been given to the Converter.
+    Once it is done, output is the path of the converted file, or error is whatever went wrong. tag is anything the caller wants to keep with it. """
+    def __init__(self, wem_path, priority = 0, tag = None, backend = None, prepare = None):
+        self.wem_path = wem_path
+        self.priority = priority
+        self.tag = tag
+        self.backend = backend
+        self.prepare = prepare  # function that puts the wem at wem_path, called on the converter's thread just before it is converted
+        self.size = 0           # size of the wem, once the job has been started
+        self.output = None
+        self.error = None
+        self.cached = False     # True if the output came out of the ConversionCache rather than being converted
+        self.key = None         # key of the output in the ConversionCache
+        self.started = False
+        self.cancelled = False  # if True the job is dropped instead of being started (it still comes out of poll())
+        self.done = threading.Event()
+
+
+class Converter():
+    """ Converts wems on a pool of threads.
+    The steps of a conversion (eg. ww2ogg and revorb) are run as separate stages, each with its own threads, so one file can
+    be going through revorb while the next is going through ww2ogg. No more than workers of the tools are ever running at once.
+    - backend:
+      ConverterBackend used for any job that isn't given its own.
+    - workers:
+      The most conversions (tool processes) to run at once. Defaults to the number of cores.
+    - cache:
+      ConversionCache to get converted files from instead of converting them, and to put newly converted ones in.
+    - fast_path:
+      ConverterBackend (eg. a PCMBackend) to use instead of backend for any job that isn't given its own and that it accepts.
+    Jobs with a lower priority number are done first. Finished jobs are collected with poll() (eg. from a tkinter after() loop),
+    so nothing is ever called from the conversion threads. """
+    def __init__(self, backend, workers = None, cache = None, fast_path = None):
+        self.backend = backend
+        self.fast_path = fast_path
+        self.cache = cache
+        self.workers = workers or cpu_count() or 1
+        self.running = threading.BoundedSemaphore(self.workers)
+        self.order = count()            # keeps jobs with the same priority in the order they were given
+        self.lock = threading.Lock()
+        self.queues = [PriorityQueue() for stage in range(STAGES)]
+        self.finished = Queue()
+        self.threads = []
+        for i in range(self.workers):
+            for stage in range(STAGES):
+                thread = threading.Thread(target = self._stage, args = (stage,), daemon = True)
+                thread.start()
+                self.threads.append(thread)
+
+    def submit(self, wem_path, priority = 0, tag = None, backend = None, prepare = None):
+        """ Add a wem to be converted by backend (or whichever the converter chooses if it is None). Returns its ConversionJob.
+        If the wem isn't at wem_path yet, prepare is called (with no arguments) to put it there before it is converted """
+        job = ConversionJob(wem_path, priority, tag, backend, prepare)
+        self.queues[0].put((priority, next(self.order), job))
+        return job
+
+    def cancel(self, job):
+        # stop the job from being converted if it hasn't been started yet
+        with self.lock:
+            if not job.started:
+                job.cancelled = True
+
+    def resume(self, job):
+        # undo cancel(). Returns False if it is too late and the job has already been dropped
+        with self.lock:
+            if job.started and job.cancelled:
+                return False
+            job.cancelled = False
+            return True
+
+    def poll(self):
+        # returns all the jobs that have finished since the last time this was called
+        jobs = []
+        while True:
+            try:
+                jobs.append(self.finished.get_nowait())
+            except Empty:
+                return jobs
+
+    def pending(self):
+        # roughly how many jobs are still waiting or being converted
+        return sum(queue.qsize() for queue in self.queues)
+
+    def shutdown(self):
+        # stop all the threads once they have finished what they are doing (anything still queued isn't converted)
+        for thread in self.threads:
+            for queue in self.queues:
+                queue.put((float('-inf'), -1, None))
+
+    def _finish(self, job, error = None):
+        job.error = error
+        if error is not None:
+            job.output = None
+        job.done.set()
+        self.finished.put(job)
+
+    def _start(self, job):
+        # choose the backend for the job and get rid of anything it was converted to before.
+        # returns True if the job could be taken straight from the cache
+        if job.backend is None:
+            if self.fast_path is not None and self.fast_path.accepts(job.wem_path):
+                job.backend = self.fast_path
+            else:
+                job.backend = self.backend
+        job.output = job.backend.output_path(job.wem_path)
+        # an old output could be a link to one in the cache, so it can't be written over. Any with other extensions are
+        # removed too so that there is only ever the latest one
+        for extension in OUTPUT_EXTENSIONS:
+            if path.exists(output_path(job.wem_path, extension)):
+                remove(output_path(job.wem_path, extension))
+        if self.cache is not None:
+            job.key = self.cache.key(job.wem_path, job.backend.version)
+            if self.cache.fetch(job.key, job.output):
+                job.cached = True
+                return True
+        return False
+
+    def _run(self, job, step):
+        if job.backend.external:
+            with self.running:
+                step(job.wem_path)
+        else:
+            step(job.wem_path)
+
+    def _stage(self, stage):
+        queue = self.queues[stage]
+        while True:
+            priority, order, job = queue.get()
+            if job is None:
+                return
+            if stage == 0:
+                with self.lock:
+                    job.started = True
+                    if job.cancelled:
+                        self._finish(job)
+                        continue
+            try:
+                if stage == 0:
+                    if job.prepare is not None:
+                        job.prepare()
+                    job.size = path.getsize(job.wem_path)
+                if stage == 0 and self._start(job):
+                    self._finish(job)
+                    continue
+                if stage == STAGES - 1:
+                    steps = job.backend.steps[stage:]
+                else:
+                    steps = job.backend.steps[stage:stage + 1]
+                for step in steps:
+                    self._run(job, step)
+                if stage + 1 < min(len(job.backend.steps), STAGES):
+                    # on to the next stage
+                    self.queues[stage + 1].put((priority, order, job))
+                    continue
+                if job.key is not None:
+                    self.cache.add(job.key, job.output)
+            except Exception as e:
+                self._finish(job, e)
+                continue
+            self._finish(job)
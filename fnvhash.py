@@ -1,18 +1,79 @@
+from functools import lru_cache
+
+# numpy is only used to hash lots of names at once. Everything still works without it, just slower
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+FNV_OFFSET = 0x811c9dc5     # Magic value for 32-bit fnv1 hash initialisation.
+FNV_PRIME = 0x01000193
+BATCH_SIZE = 0x10000        # number of names hashed at once by numpy (so the byte matrix doesn't get too big)
+
+
 def fnvhash(s):
     s = s.lower()
-    hval = 0x811c9dc5 # Magic value for 32-bit fnv1 hash initialisation.
-    fnvprime = 0x01000193
-    fnvsize = 2**32
     if not isinstance(s, bytes):
         s = s.encode("UTF-8", "ignore")
-    for byte in s:
-        hval = (hval * fnvprime) % fnvsize
-        hval = hval ^ byte
+    return fnvhash_update(FNV_OFFSET, s)
+
+def fnvhash_update(hval, data):
+    # continue a hash (hval) with some more bytes. fnvhash(a + b) == fnvhash_update(fnvhash(a), b.lower()) so the hash of
+    # a common prefix only needs to be worked out once. data needs to already be lower case bytes
+    for byte in data:
+        hval = ((hval * FNV_PRIME) & 0xFFFFFFFF) ^ byte
     return hval
 
+@lru_cache(maxsize = 0x10000)
+def cached_fnvhash(s):
+    # same as fnvhash, but names that have been hashed before are just looked up
+    return fnvhash(s)
+
+def fnvhash_batch(names):
+    """ Returns a list of the fnv hashes of all the names (gives exactly the same values as fnvhash on each one).
+    If numpy is installed all the names are hashed at once, a byte at a time over all of them. """
+    encoded = []
+    for s in names:
+        s = s.lower()
+        if not isinstance(s, bytes):
+            s = s.encode("UTF-8", "ignore")
+        encoded.append(s)
+    if np is None:
+        return [fnvhash_update(FNV_OFFSET, s) for s in encoded]
+    hashes = []
+    for start in range(0, len(encoded), BATCH_SIZE):
+        hashes.extend(_hash_matrix(encoded[start:start + BATCH_SIZE]))
+    return hashes
+
+def _hash_matrix(encoded):
+    # hash a batch of names with numpy. The names are sorted longest first and put into a zero padded matrix,
+    # so that at each byte position all the names still being hashed are the first ones and can be done in one go
+    lengths = np.fromiter((len(s) for s in encoded), dtype = np.int64, count = len(encoded))
+    order = np.argsort(-lengths, kind = 'stable')
+    sorted_lengths = lengths[order]
+    width = int(sorted_lengths[0]) if len(encoded) != 0 else 0
+    # the matrix is stored a byte position per row so that each step below works on contiguous memory
+    matrix = np.zeros((width, len(encoded)), dtype = np.uint32)
+    # scatter all the bytes into the matrix at once: column i gets the bytes of the i'th longest name
+    flat = np.frombuffer(b''.join([encoded[i] for i in order]), dtype = np.uint8)
+    starts = np.cumsum(sorted_lengths) - sorted_lengths
+    matrix[np.arange(len(flat)) - np.repeat(starts, sorted_lengths), np.repeat(np.arange(len(encoded)), sorted_lengths)] = flat
+    # number of names that are longer than each byte position
+    active = len(encoded) - np.searchsorted(sorted_lengths[::-1], np.arange(width), side = 'right')
+    hvals = np.full(len(encoded), FNV_OFFSET, dtype = np.uint32)
+    prime = np.uint32(FNV_PRIME)
+    for column in range(width):
+        count = int(active[column])
+        # uint32 multiplication wraps around, which is the same as the & 0xFFFFFFFF
+        hvals[:count] = (hvals[:count] * prime) ^ matrix[column, :count]
+    result = np.empty_like(hvals)
+    result[order] = hvals
+    return result.tolist()
+
+
 if __name__ == "__main__":
     from itertools import combinations
-    
+
     while True:
         _input = input("Enter the name: ")
         if _input != "exit!!":
@@ -20,7 +81,7 @@ if __name__ == "__main__":
             print(hex(v), v)
         else:
             break
-    
+
     """
     s = '\Events\Default Work Unit\MUS_Loading\MUS_Loading32'
     for l in range(1, len(s)+1):
@@ -0,0 +1,179 @@
+# file containing the tool to recover the names of ids that we only have the hash of.
+# Names are built from templates such as '\Events\Default Work Unit\{0}\{0}_{1}', where each {N} is filled in with every
+# word from the N'th wordlist, and each one is hashed and checked against the ids we are looking for.
+# Because fnv works a byte at a time, the hash of everything before a {N} is only worked out once and then carried on from
+# for each word, so a template with a long known path costs no more to search than one without it.
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from os import cpu_count
+import re
+
+from fnvhash import fnvhash_update, FNV_OFFSET, FNV_PRIME
+
+SLOT = re.compile(r'\{(\d+)\}')
+FNV_PRIME_INVERSE = pow(FNV_PRIME, -1, 0x100000000)     # multiplying by this undoes multiplying by FNV_PRIME (mod 2^32)
+JOBS_PER_WORKER = 4         # the words of the first slot are split into this many jobs per process so they finish around the same time
+
+# these are set in each worker process by _init_worker so that they are only sent to it once
+_wordlists = None
+_targets = None
+
+
+def parse_template(template):
+    """ Split a template into its literal text and slots.
+    Returns (literals, slots) where literals has one more entry than slots, and the name is
+    literals[0] + word from wordlist slots[0] + literals[1] + ... + literals[-1] """
+    literals = []
+    slots = []
+    pos = 0
+    for match in SLOT.finditer(template):
+        literals.append(template[pos:match.start()])
+        slots.append(int(match.group(1)))
+        pos = match.end()
+    literals.append(template[pos:])
+    return literals, slots
+
+def encode(s):
+    # the bytes that fnvhash actually hashes for s
+    return s.lower().encode("UTF-8", "ignore")
+
+def load_wordlist(file_path):
+    # read a wordlist file (one word per line). Duplicates are removed but the order is kept
+    with open(file_path, 'r', encoding = 'utf-8', errors = 'ignore') as f:
+        return list(dict.fromkeys(line.strip() for line in f if line.strip() != ''))
+
+def load_targets(file_path):
+    # read a file of ids (one per line, in decimal or hex starting with 0x)
+    targets = set()
+    with open(file_path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if line != '':
+                targets.add(int(line, 0))
+    return targets
+
+def unhash(hval, data):
+    # the opposite of fnvhash_update: returns the hash that, carried on with data, gives hval
+    for byte in reversed(data):
+        hval = ((hval ^ byte) * FNV_PRIME_INVERSE) & 0xFFFFFFFF
+    return hval
+
+def search_slots(hval, literals, slots, wordlists, targets, words, found, depth = 0):
+    """ Carry on the hash hval (which already includes literals[:depth + 1] and the words so far) with every combination of words
+    for the rest of the slots, adding (id, name) to found for any that are in targets.
+    wordlists is a list of lists of (word, encoded word)
+    targets is a dictionary of the hash before the last literal: the id, so the last literal doesn't need to be hashed each time
+    (see unhash) """
+    if depth == len(slots) - 1:
+        # this is where almost all the time goes, so the hashing is done right here instead of calling fnvhash_update
+        for word, data in wordlists[slots[depth]]:
+            h = hval
+            for byte in data:
+                h = ((h * FNV_PRIME) & 0xFFFFFFFF) ^ byte
+            if h in targets:
+                found.append((targets[h], ''.join(_build_name(literals, words + [word]))))
+        return
+    literal = encode(literals[depth + 1])
+    for word, data in wordlists[slots[depth]]:
+        words.append(word)
+        search_slots(fnvhash_update(fnvhash_update(hval, data), literal), literals, slots, wordlists, targets, words, found, depth + 1)
+        words.pop()
+
+def _build_name(literals, words):
+    for i in range(len(words)):
+        yield literals[i]
+        yield words[i]
+    yield literals[len(words)]
+
+def _init_worker(wordlists, targets):
+    global _wordlists, _targets
+    _wordlists = wordlists
+    _targets = targets
+
+def _search_job(prefix, template, start, end):
+    # search the template (with prefix on the front) using only words start:end of the first slot's wordlist
+    literals, slots = parse_template(template)
+    literals[0] = prefix + literals[0]
+    hval = fnvhash_update(FNV_OFFSET, encode(literals[0]))
+    wordlists = list(_wordlists)
+    wordlists[slots[0]] = wordlists[slots[0]][start:end]
+    if slots.count(slots[0]) > 1:
+        # the same wordlist is used again later in the template, that one needs all the words
+        wordlists.append(_wordlists[slots[0]])
+        slots = [slots[0]] + [len(wordlists) - 1 if s == slots[0] else s for s in slots[1:]]
+    last_literal = encode(literals[-1])
+    targets = dict((unhash(target, last_literal), target) for target in _targets)
+    found = []
+    search_slots(hval, literals, slots, wordlists, targets, [], found)
+    return found
+
+def search(targets, templates, wordlists, prefixes = ('',), workers = None, progress = None):
+    """ Find names for as many of the ids in targets as possible.
+    - templates:
+      List of templates. {N} in a template is replaced by each word in wordlists[N].
+    - wordlists:
+      List of lists of words.
+    - prefixes:
+      Each template is also tried with each of these on the front (eg. 'Play_' for events).
+    - workers:
+      Number of processes to use. Defaults to the number of cores.
+    - progress:
+      Function called as progress(jobs done, total jobs, number of names found so far)
+    Returns a dictionary of id: list of names that hash to it. """
+    targets = set(targets)
+    encoded = [[(word, encode(word)) for word in wordlist] for wordlist in wordlists]
+    if workers is None:
+        workers = cpu_count() or 1
+    results = dict()
+    def add(found):
+        for h, name in found:
+            names = results.setdefault(h, [])
+            if name not in names:
+                names.append(name)
+    jobs = []
+    for prefix in prefixes:
+        for template in templates:
+            literals, slots = parse_template(template)
+            if any(slot >= len(wordlists) for slot in slots):
+                raise ValueError('Template {0} uses a wordlist that wasn\'t given'.format(template))
+            if len(slots) == 0:
+                # nothing to fill in, so just check the name itself
+                h = fnvhash_update(FNV_OFFSET, encode(prefix + template))
+                if h in targets:
+                    add([(h, prefix + template)])
+                continue
+            num_words = len(wordlists[slots[0]])
+            step = max(1, -(-num_words // (workers * JOBS_PER_WORKER)))
+            for start in range(0, num_words, step):
+                jobs.append((prefix, template, start, start + step))
+    if len(jobs) == 0:
+        return results
+    with ProcessPoolExecutor(max_workers = workers, initializer = _init_worker, initargs = (encoded, targets)) as pool:
+        futures = [pool.submit(_search_job, *job) for job in jobs]
+        done = 0
+        for future in as_completed(futures):
+            add(future.result())
+            done += 1
+            if progress is not None:
+                progress(done, len(jobs), len(results))
+    return results
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description = "Recover the names of fnv hashed ids")
+    parser.add_argument('templates', nargs = '+', help = "templates of the names to try. {0}, {1}... are replaced with the words of the 1st, 2nd... wordlist")
+    parser.add_argument('-t', '--targets', required = True, help = "file of the ids to find names for, one per line")
+    parser.add_argument('-w', '--wordlist', action = 'append', default = [], help = "file of words, one per line. Can be given more than once")
+    parser.add_argument('-p', '--prefix', action = 'append', default = [], help = "known prefix to try on the front of each template. Can be given more than once")
+    parser.add_argument('-j', '--workers', type = int, default = None, help = "number of processes to use")
+    args = parser.parse_args()
+
+    def print_progress(done, total, num_found):
+        print('{0}/{1} jobs done, {2} ids found'.format(done, total, num_found))
+
+    results = search(load_targets(args.targets), args.templates, [load_wordlist(w) for w in args.wordlist],
+                     prefixes = args.prefix or [''], workers = args.workers, progress = print_progress)
+    for h in sorted(results):
+        for name in results[h]:
+            print(h, name)
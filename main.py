@@ -27,34 +27,42 @@ except ImportError:
 
 from collections import OrderedDict
 
-root = Tk()
-
 import xml.etree.ElementTree as ET
 
 from BNKcompiler import *
+from fnvhash import fnvhash
 from xml_worker import xml_worker
 from txt_worker import txt_worker
+from bnk_index import load_index
+from bulk_extract import extract_all
+from catalog import Catalog, SoundBankIndex, SoundBankRecord, StreamedRowsCache
+from converter import Converter, ToolBackend, CommandBackend, PCMBackend, convert_wem, find_output
+from conversion_cache import ConversionCache
+from prefetch import Prefetcher
+from wem_index import WEMLocationIndex
+from wem_store import WEMStore
+from wem_writer import StoreSink
+from wem_pack import WEMPack, PackSink, has_pack
 
 DEFAULTSETTINGS = {'audioPath': "",
                    'additionPath': "TO_ADD",
                    'outputPath': "OUTPUT",
                    'workingPath': "TEMP",
                    'toolPath': 'Tools',
-                   'convertedPath': 'CONVERTED'}
+                   'convertedPath': 'CONVERTED',
+                   'cachePath': 'CACHE',
+                   'packedWorking': False,
+                   'conversionWorkers': 0,      # 0 means one per core
+                   'conversionCacheSize': 2048,     # MB of converted files to keep
+                   'converter': 'tools',            # 'tools' for ww2ogg and revorb, or 'command' to use converterCommand
+                   'converterCommand': '',          # eg. 'vgmstream-cli -o "{output}" "{input}"'
+                   'converterExtension': '.wav',    # what converterCommand makes
+                   'pcmFastPath': True,             # PCM wems are just rewritten as wavs instead of being converted
+                   'prefetch': False,               # convert the audio around whatever is selected before it is asked for
+                   'prefetchAhead': 4,              # number of rows after the selected one to convert
+                   'prefetchBudget': 64}            # most MB of wems to be converting ahead at once
 APPSPATH = 'Apps'
 
-def fnvhash(s):
-    s = s.lower()
-    hval = 0x811c9dc5 # Magic value for 32-bit fnv1 hash initialisation.
-    fnvprime = 0x01000193
-    fnvsize = 2**32
-    if not isinstance(s, bytes):
-        s = s.encode("UTF-8", "ignore")
-    for byte in s:
-        hval = (hval * fnvprime) % fnvsize
-        hval = hval ^ byte
-    return hval
-
 # not sure if I will use the following 4 classes. Maybe later to make things a bit more powerful... *maybe*
 
 class NMSAudio():
@@ -86,7 +94,10 @@ class GUI(Frame):
 
         self.textFont = font.Font(self, "Calibiri", "12")
 
-        self.SoundBanksData = []     # this will hold all the soundbank Element objects that can be read from directly
+        self.SoundBanksData = []     # this will hold all the SoundBankRecords, from the catalog of the SOUNDBANKSINFO.XML
+        self.SoundBanksIndex = SoundBankIndex([])       # and this lets us find them by name, id or path
+        self.StreamedRows = StreamedRowsCache()         # the streamed files of the last few banks that were looked at
+        self.catalog = None
 
         self.selectedAudioListType = 'Str'      # other possibilities: 'Inc' and 'Act'
         self.searchTerm = StringVar()
@@ -121,12 +132,36 @@ class GUI(Frame):
         self.settings['workingPath'] = path.abspath('TEMP')
         self.settings['convertedPath'] = path.abspath('CONVERTED')
         self.settings['toolPath'] = path.abspath('Tools')
+        self.settings['cachePath'] = path.abspath('CACHE')
         print(self.settings)
 
+        self.packedWorking.set(self.settings['packedWorking'])
+
+        # every wem that is extracted, replaced or converted is kept once in here and linked to wherever it is needed
+        self.store = WEMStore(path.join(self.settings['cachePath'], 'wems'))
+
+        # wems are converted in the background, and the finished ones are checked for every so often.
+        # anything that has been converted before is just taken from the cache
+        self.conversion_cache = ConversionCache(path.join(self.settings['cachePath'], 'converted'),
+                                                max_size = self.settings['conversionCacheSize'] * 0x100000)
+        self.conversion_cache.clean()
+        self.converter = Converter(self.get_backend(), workers = self.settings['conversionWorkers'] or None,
+                                   cache = self.conversion_cache,
+                                   fast_path = PCMBackend() if self.settings['pcmFastPath'] else None)
+        self.conversions_done = 0
+        self.converting = dict()        # path of each wem being converted: number of jobs converting it
+        self.prefetcher = Prefetcher(self.converter, max_bytes = self.settings['prefetchBudget'] * 0x100000)
+        self.prefetchEnabled.set(self.settings['prefetch'])
+        self.after(100, self.poll_conversions)
+
         if not path.exists(self.settings['audioPath']):
             messagebox.showwarning("Bad Paths!", message = "Paths in settings are incorrect. Please reset!")
             self.getPaths()
 
+        # where every streamed wem is in the AUDIO folder, so that they never need to be searched for
+        self.wem_locations = None
+        self.get_wem_locations()
+
         self.generateSoundBankData()
 
         # populate the list of soundbanks
@@ -201,6 +236,7 @@ class GUI(Frame):
         self.IncludedListView["show"] = 'headings'
         self.IncludedListView.tag_configure('modified', background='green')
         self.IncludedListView.bind('<ButtonRelease-1>', lambda *args: self.check_file_exists(self.IncludedListView))
+        self.IncludedListView.bind('<<TreeviewSelect>>', lambda *args: self.prefetch_conversions(self.IncludedListView))
         i_ysb = ttk.Scrollbar(IncludedListFrame, orient=VERTICAL, command=self.IncludedListView.yview)
         i_ysb.pack(side=RIGHT, fill=Y)
         self.IncludedListView.configure(yscroll=i_ysb.set)
@@ -220,6 +256,7 @@ class GUI(Frame):
         self.StreamedListView["show"] = 'headings'
         self.StreamedListView.tag_configure('modified', background='green')
         self.StreamedListView.bind('<ButtonRelease-1>', lambda *args: self.check_file_exists(self.StreamedListView))
+        self.StreamedListView.bind('<<TreeviewSelect>>', lambda *args: self.prefetch_conversions(self.StreamedListView))
         s_ysb = ttk.Scrollbar(StreamedListFrame, orient=VERTICAL, command=self.StreamedListView.yview)
         s_ysb.pack(side=RIGHT, fill=Y)
         self.StreamedListView.configure(yscroll=s_ysb.set)
@@ -235,6 +272,8 @@ class GUI(Frame):
         seachCommand = self.register(self.SearchAudioList)
         self.SoundsSortEntry = Entry(self.searchFrame, textvariable = self.searchTerm, validatecommand = (seachCommand, '%P'), validate = 'key')
         self.SoundsSortEntry.pack(side = LEFT)
+        self.searchAllButton = Button(self.searchFrame, text = "Search All", command = self.open_global_search)
+        self.searchAllButton.pack(side = LEFT)
         self.progbar = ttk.Progressbar(self.searchFrame, maximum=self.num_files, variable=self.curr_progress)
         self.progbar.pack(side = LEFT)
         self.searchFrame.pack()
@@ -261,6 +300,8 @@ class GUI(Frame):
         self.unpack_button.pack()
         self.unpack_select_button = Button(self.AudioButtonFrame, text = "Unpack Selected", command = self.unpack_soundbank_threaded_selected)
         self.unpack_select_button.pack()
+        self.unpack_game_button = Button(self.AudioButtonFrame, text = "Unpack Game", command = self.unpack_all_soundbanks_threaded)
+        self.unpack_game_button.pack()
         self.repack_button = Button(self.AudioButtonFrame, text = "Repack", command = self.repack_soundbank_threaded)
         self.repack_button.pack()
         self.add_button = Button(self.AudioButtonFrame, text = "Add", command = self.add_audio_precheck, state = DISABLED)
@@ -287,6 +328,14 @@ class GUI(Frame):
         self.setupMenu.add_command(label="Set AUDIO directory", command = self.getAudioPath)
         self.setupMenu.add_command(label="Set output directory", command = self.getOutputPath)
         self.setupMenu.add_command(label="Set working directory", command = self.getAdditionPath)
+        # whether banks are unpacked into a single pack file each instead of a file per wem
+        self.packedWorking = BooleanVar()
+        self.setupMenu.add_checkbutton(label="Unpack into pack files", variable = self.packedWorking,
+                                       command = lambda: self.settings.update(packedWorking = self.packedWorking.get()))
+        # whether the audio around the selection is converted in the background before it is asked for
+        self.prefetchEnabled = BooleanVar()
+        self.setupMenu.add_checkbutton(label="Convert ahead while browsing", variable = self.prefetchEnabled,
+                                       command = lambda: self.settings.update(prefetch = self.prefetchEnabled.get()))
 
         self.master.config(menu = self.menuBar)
 
@@ -370,26 +419,17 @@ class GUI(Frame):
             self.SearchAudioList(self.searchTerm.get())
 
     def generateSoundBankData(self):
-        tree = ET.ElementTree()
-        tree.parse(path.join(self.settings['audioPath'], 'SOUNDBANKSINFO.XML'))
-        self.SoundBanksData = list(tree.find('SoundBanks').iter("SoundBank"))
-        
+        # the xml is only actually read if it has changed since the catalog was last made
+        if not path.exists(self.settings['cachePath']):
+            makedirs(self.settings['cachePath'])
+        self.catalog = Catalog(path.join(self.settings['cachePath'], 'catalog.db'), self.settings['audioPath'])
+        self.SoundBanksData = self.catalog.soundbanks
+        self.SoundBanksIndex = SoundBankIndex(self.SoundBanksData)
+        self.StreamedRows = StreamedRowsCache(loader = self.catalog.streamed_rows)
+
     def searchSoundBanks(self, name):
-        # search the list of soundbank nodes for the correct one and return it
-        # receive the name as we can hash it to get the Id which can then be found
-        language_sb = False
-        if name.startswith('Vocal_Localised'):
-            language = name[len('Vocal_Localised') + 2 : -1]
-            name = 'Vocal_Localised'
-            language_sb = True
-        Id = str(fnvhash(name))
-        for sb in self.SoundBanksData:
-            if language_sb == False:
-                if sb.attrib['Id'] == Id:
-                    return sb
-            else:
-                if sb.attrib['Id'] == Id and sb.attrib['Language'] == language:
-                    return sb
+        # find the soundbank node with the name shown in the list (the localised ones have their language on the end)
+        return self.SoundBanksIndex.find(name)
 
     def SearchAudioList(self, term):
         # populate each of the trees with only the entries that contain the substring 'term'
@@ -401,29 +441,86 @@ class GUI(Frame):
             self.populateIncludedList(compare = term)
         return True
 
+    def open_global_search(self):
+        # open a window to search every soundbank at once
+        if self.catalog is None:
+            return
+        window = Toplevel(self.master)
+        window.title("Search all soundbanks")
+        term = StringVar()
+        entry = Entry(window, textvariable = term, state = DISABLED)
+        entry.pack(fill = X)
+        status = Label(window, text = "Indexing soundbanks...")
+        status.pack()
+        resultsFrame = Frame(window)
+        results = ttk.Treeview(resultsFrame, columns = ['Sound Bank', 'Type', 'Name', 'Id'], displaycolumns = '#all', selectmode = 'browse')
+        for col, width in [('Sound Bank', 200), ('Type', 70), ('Name', 350), ('Id', 90)]:
+            results.heading(col, text = col, command = lambda _col = col: self.treeview_sort_column(results, _col, False))
+            results.column(col, stretch = True, width = width)
+        results["show"] = 'headings'
+        r_ysb = ttk.Scrollbar(resultsFrame, orient=VERTICAL, command=results.yview)
+        r_ysb.pack(side=RIGHT, fill=Y)
+        results.configure(yscroll=r_ysb.set)
+        results.pack(fill=BOTH, expand=YES)
+        resultsFrame.pack(fill=BOTH, expand=YES)
+        # double clicking a result shows it in the main window
+        results.bind('<Double-1>', lambda *args: self.show_search_result(results))
+
+        def update_results(*args):
+            found = self.catalog.search(term.get())
+            results.delete(*results.get_children())
+            for row in found:
+                results.insert("", "end", values = list(row))
+            status.config(text = "{} results".format(len(found)))
+        term.trace_add('write', update_results)
+
+        # every bank's xml needs to be in the catalog to search it, which can take a little while the first time, so do it in the background
+        indexer = threading.Thread(target = self.catalog.refresh_search)
+        indexer.start()
+        def wait_for_index():
+            if indexer.is_alive():
+                window.after(100, wait_for_index)
+            else:
+                entry.config(state = NORMAL)
+                status.config(text = "")
+                entry.focus_set()
+        wait_for_index()
+
+    def show_search_result(self, results):
+        # select the bank of a global search result, and show the result in its list
+        values = results.item(results.focus())['values']
+        if not values:
+            return
+        bank, kind, name, Id = [str(v) for v in values]
+        for iid in self.SoundBanksListView.get_children():
+            if str(self.SoundBanksListView.item(iid)['values'][0]) == bank:
+                break
+        else:
+            return
+        # the list is filtered down to just the result using the normal search
+        self.searchTerm.set(name if kind == 'event' else Id)
+        self.SoundBanksListView.selection_set(iid)
+        self.SoundBanksListView.focus(iid)
+        self.SoundBanksListView.see(iid)
+        if kind == 'event':
+            self.show_actions()
+        elif kind == 'included':
+            self.show_included()
+        else:
+            self.show_streamed()
+
     @staticmethod
     def getEvents(soundbank):
-        IncludedEvents = soundbank.find('IncludedEvents')
-        try:
-            return IncludedEvents.findall('Event')
-        except:
-            return []
+        # these all return the (name, id) AudioRows of the soundbank record
+        return soundbank.events
 
     @staticmethod
     def getStreamed(soundbank):
-        ReferencedStreamedFiles = soundbank.find('ReferencedStreamedFiles')
-        try:
-            return ReferencedStreamedFiles.findall('File')
-        except:
-            return []
+        return soundbank.streamed
 
     @staticmethod
     def getIncluded(soundbank):
-        IncludedMemoryFiles = soundbank.find('IncludedMemoryFiles')
-        try:
-            return IncludedMemoryFiles.findall('File')
-        except:
-            return []
+        return soundbank.included
     
     def treeview_sort_column(self, tv, col, reverse):
         l = [(tv.set(k, col), k) for k in tv.get_children('')]
@@ -448,11 +545,10 @@ class GUI(Frame):
     def populateSoundBankList(self):
         # this will populate the soud bank list with all the names
         for sb in self.SoundBanksData:
-            name = sb.find('ShortName').text
-            path = sb.find('Path').text.upper()
+            name = sb.short_name
+            path = sb.path.upper()
             if name == 'Vocal_Localised':
-                region = sb.find('Path').text.split('\\')[0]
-                name = '{0}_[{1}]'.format(name, region)
+                name = sb.display_name
                 self.SoundBanksListView.insert("", "end", values=[name, path])
             elif name == 'NMS_Audio_Persistent':
                 self.SoundBanksListView.insert("", 0, values=[name, path])
@@ -468,12 +564,12 @@ class GUI(Frame):
         # now get the info and populate
         sb_name = self.getSelectedSoundbankName()
         soundbank = self.searchSoundBanks(sb_name)
-        for event in self.getEvents(soundbank):
+        for name, Id in self.getEvents(soundbank):
             if compare == '':
-                self.ActionListView.insert("", "end", values=event.attrib["Name"])
+                self.ActionListView.insert("", "end", values=name)
             else:
-                if compare.upper() in event.attrib["Name"].upper():
-                    self.ActionListView.insert("", "end", values=event.attrib["Name"])
+                if compare.upper() in name.upper():
+                    self.ActionListView.insert("", "end", values=name)
 
     def populateStreamedList(self, compare = ''):
         # this will find what sound bank is selected and populate the action list with the list of actions in the bank
@@ -488,19 +584,12 @@ class GUI(Frame):
         sb_path = path.splitext(self.getSelectedSoundbankPath())[0]
 
         # we need to do one extra step because the names of streamed files are not in the soundbanksinfo.xml, but only in the actual <soundbank_name>.xml
-        sb_tree = ET.ElementTree()
-        sb_tree.parse(path.join(self.settings['audioPath'], '{}.XML'.format(sb_path)))
-        soundbank = sb_tree.find('SoundBanks').find("SoundBank")
-        
-        #soundbank = self.searchSoundBanks(sb_name)
-        for event in self.getStreamed(soundbank):
-            if compare == '':
-                # just display the full list with no culling
-                self.StreamedListView.insert("", "end", values=[event.find("ShortName").text, event.attrib['Id']])
-            else:
-                # display only the entries in the list that contain the substring
-                if compare.upper() in event.find("ShortName").text.upper() or compare.upper() in event.attrib["Id"].upper():
-                    self.StreamedListView.insert("", "end", values=[event.find("ShortName").text, event.attrib['Id']])
+        # (this is only actually read the first time, or if it has changed)
+        rows = self.StreamedRows.get(path.join(self.settings['audioPath'], '{}.XML'.format(sb_path)))
+
+        # display only the entries in the list that contain the substring (or all of them if there isn't one)
+        for name, Id in rows.filter(compare):
+            self.StreamedListView.insert("", "end", values=[name, Id])
 
     def populateIncludedList(self, compare = ''):
         # this will find what sound bank is selected and populate the action list with the list of actions in the bank
@@ -511,12 +600,8 @@ class GUI(Frame):
         # now get the info and populate
         sb_name = self.getSelectedSoundbankName()
         soundbank = self.searchSoundBanks(sb_name)
-        for event in self.getIncluded(soundbank):
-            if compare == '':
-                self.IncludedListView.insert("", "end", values=[event.find("ShortName").text, event.attrib['Id']])
-            else:
-                if compare.upper() in event.find("ShortName").text.upper() or compare.upper() in event.attrib["Id"].upper():
-                    self.IncludedListView.insert("", "end", values=[event.find("ShortName").text, event.attrib['Id']])
+        for name, Id in self.getIncluded(soundbank).filter(compare):
+            self.IncludedListView.insert("", "end", values=[name, Id])
 
     def unpack_soundbank_threaded_selected(self, selectionMode = 'many'):
         if selectionMode == 'many':
@@ -542,16 +627,58 @@ class GUI(Frame):
         unpack_thread = threading.Thread(target = lambda: self.unpack_soundbank(speedmode = speedmode))
         unpack_thread.start()
 
-    def unpack_soundbank(self, specific_ids = [], speedmode = False):
+    def unpack_soundbank(self, specific_ids = [], speedmode = False, sb_name = None):
+        # sb_name is the soundbank to unpack, by default the one that is selected
         self.threadLock.acquire()
-        sb_name = self.getSelectedSoundbankName()
+        try:
+            self.unpack_soundbank_locked(specific_ids, speedmode, sb_name or self.getSelectedSoundbankName())
+        finally:
+            self.threadLock.release()
+
+    def unpack_soundbank_locked(self, specific_ids, speedmode, sb_name):
         soundbank = self.searchSoundBanks(sb_name)
         # get the actual path of the soundbank itself, and then move it into the APPSPATH
-        soundbank_path = path.join(self.settings['audioPath'], soundbank.find('Path').text.upper())
+        soundbank_path = path.join(self.settings['audioPath'], soundbank.path.upper())
         b = BNK(sb_name.upper(), soundbank_path, path.join(self.settings['workingPath'], sb_name.upper()), counter = self.curr_progress)
-        b.extract(specific_ids, speedmode = speedmode)
+        if len(specific_ids) != 0:
+            # use the cached index of the bnk so that only the wems themselves need to be read from it
+            index = load_index(soundbank_path, cache_dir = path.join(self.settings['cachePath'], 'bnkidx'))
+        else:
+            index = None
+        if self.settings['packedWorking'] and not speedmode:
+            # everything goes into one file (only starting again if the whole bank is being unpacked)
+            sink = PackSink(path.join(self.settings['workingPath'], sb_name.upper()), sb_name.upper(), reset = len(specific_ids) == 0)
+            incremental = False
+        else:
+            sink = StoreSink(self.store, path.join(self.settings['workingPath'], sb_name.upper()))
+            incremental = True
+        try:
+            b.extract(specific_ids, speedmode = speedmode, index = index, sink = sink, incremental = incremental)
+        finally:
+            sink.close()
+        print(sink.summary())
         self.checkButtonStates()
-        self.threadLock.release()
+
+    def unpack_all_soundbanks_threaded(self, names = None):
+        # unpack every soundbank (or just the ones in names) using all the cores
+        unpack_thread = threading.Thread(target = lambda: self.unpack_all_soundbanks(names))
+        unpack_thread.start()
+
+    def unpack_all_soundbanks(self, names = None):
+        self.threadLock.acquire()
+        self.unpack_game_button.config(state = DISABLED)
+        self.progbar['maximum'] = len(self.SoundBanksData)
+        def progress(done, total, num_wems, name):
+            self.progbar['maximum'] = total
+            self.curr_progress.set(done)
+            print('Unpacked {0} ({1}/{2}, {3} wems)'.format(name, done, total, num_wems))
+        try:
+            errors = extract_all(self.settings['audioPath'], self.settings['workingPath'], names = names, progress = progress)
+            for name in errors:
+                print('Failed to unpack {0}: {1}'.format(name, errors[name]))
+        finally:
+            self.unpack_game_button.config(state = NORMAL)
+            self.threadLock.release()
 
     def repack_soundbank_threaded(self, overrides = None):
         # override is a path to override specifically running this on the currently selected soundbank
@@ -595,6 +722,10 @@ class GUI(Frame):
                 #name = path.splitext(file)[0]
                 if path.splitext(file)[1] == dtype:
                     counter += 1
+                if path.splitext(file)[1] == '.pidx' and dtype == '.wem':
+                    # all the wems in a pack count too
+                    with WEMPack(root, path.splitext(file)[0]) as wem_pack:
+                        counter += len(wem_pack)
         return counter
 
     def add_audio_precheck(self):
@@ -635,19 +766,19 @@ class GUI(Frame):
             # check to make sure that the bnk, txt and xml files are also in the same directory
             tree = ET.ElementTree()
             tree.parse(soundbankinfo_add)
-            SoundBanksData = list(tree.find('SoundBanks').iter("SoundBank"))
+            SoundBanksData = [SoundBankRecord.from_element(sb) for sb in tree.find('SoundBanks').iter("SoundBank")]
             for sb in iter(SoundBanksData):
-                if sb.attrib['Id'] == '1355168291':
+                if sb.id == '1355168291':
                     # this is the hash of the init soundbank
                     SoundBanksData.remove(sb)
             # we now have just the soundbank data for the soundbanks that include data to be added, not including Init.
             # Not sure what to do if we have more than one soundbank... We'll see...
             # let's just assume there is only one...
             sb = SoundBanksData[0]
-            sb_name = sb.find("ShortName").text
+            sb_name = sb.short_name
             events = self.getEvents(sb)
-            streamed_ids = [a.attrib['Id'] for a in self.getStreamed(sb)]
-            included_ids = [a.attrib['Id'] for a in self.getIncluded(sb)]
+            streamed_ids = list(self.getStreamed(sb).ids)
+            included_ids = list(self.getIncluded(sb).ids)
             print(streamed_ids)
             print(included_ids)
             
@@ -676,10 +807,10 @@ class GUI(Frame):
                 for file in files:
                     if path.splitext(file)[0] in included_ids:
                         # if the names of the file is in the list of included ids, then we move to the working directory
-                        shutil.copy(path.join(root, dirs, file), working_path)
+                        self.store.add(path.join(root, file), path.join(working_path, file))
                     if path.splitext(file)[1] == 'hirc':
                         # also move any hirc stuff over
-                        shutil.copy(path.join(root, dirs, file), working_path)
+                        shutil.copy(path.join(root, file), working_path)
             # now repack the whole lot
             print("Repacking bank")
             print(working_path)
@@ -692,7 +823,8 @@ class GUI(Frame):
                     print(path.splitext(file)[0])
                     if path.splitext(file)[0] in streamed_ids:
 
-                        shutil.copy(path.join(root, file), out_path)
+                        self.store.add(path.join(root, file), path.join(out_path, file))
+            self.store.save()
 
         """
         for folder in listdir(add_path):
@@ -718,11 +850,14 @@ class GUI(Frame):
         iid = self.SoundBanksListView.focus()
         return self.SoundBanksListView.item(iid)['values'][1]
 
+    def converted_file(self, sb_id):
+        # the converted file (ogg or wav) of the audio with the id, or None if it hasn't been converted
+        return find_output(path.join(self.settings['convertedPath'], "{}.WEM".format(sb_id)))
+
     def check_file_exists(self, tview):
         iid = tview.focus()
         sb_id = tview.item(iid)['values'][1]
-        new_file = path.join(self.settings['convertedPath'], "{}.ogg".format(sb_id))
-        if path.exists(new_file):
+        if self.converted_file(sb_id) is not None:
             self.playButton.configure(state = NORMAL)
             self.stopButton.configure(state = NORMAL)
         else:
@@ -758,15 +893,26 @@ class GUI(Frame):
             # make sure something has actually been selected
             if self.selectedAudioListType == 'Str':
                 # in this case we don't need to do any repacking of the bnk. We can simply replace the .wem in the AUDIO folder (ie. output folder)
-                wem_id = self.getSelectedAudioId(self.StreamedListView)
-                shutil.copy(replacement_file, path.join(out_path, '{}.WEM'.format(wem_id)))
+                wem_id = self.StreamedListView.item(self.StreamedListView.focus())['values'][1]
+                self.store.add(replacement_file, path.join(out_path, '{}.WEM'.format(wem_id)))
                 self.highlightSelectedAudioId(self.StreamedListView)
             elif self.selectedAudioListType == 'Inc':
-                wem_id = self.getSelectedAudioId(self.IncludedListView)
-                # now, we need to extract the entire bnk into the working directory, replace the existing file with the replacement one, then repack.
-                wem_id = self.getSelectedAudioId(self.IncludedListView)
-                shutil.copy(replacement_file, path.join(working_path, self.getSelectedSoundbankName().upper(), '{}.WEM'.format(wem_id)))
+                wem_id = self.IncludedListView.item(self.IncludedListView.focus())['values'][1]
+                sb_name = self.getSelectedSoundbankName().upper()
+                # instead of extracting and repacking the entire bnk, we just patch the wem straight into a copy of the bnk in the output folder
+                out_bnk = path.join(out_path, '{}.BNK'.format(sb_name))
+                if not path.exists(out_bnk):
+                    shutil.copy(path.join(self.settings['audioPath'], self.getSelectedSoundbankPath()), out_bnk)
+                patch_wem(out_bnk, wem_id, replacement_file)
+                # if the bnk has been extracted then keep the extracted copy up to date too
+                if has_pack(path.join(working_path, sb_name), sb_name):
+                    with open(replacement_file, 'rb') as f:
+                        with PackSink(path.join(working_path, sb_name), sb_name) as sink:
+                            sink.write(wem_id, f.read())
+                elif path.exists(path.join(working_path, sb_name)):
+                    self.store.add(replacement_file, path.join(working_path, sb_name, '{}.WEM'.format(wem_id)))
                 self.highlightSelectedAudioId(self.IncludedListView)
+            self.store.save()
 
     def get_selectedSB(self):
         # simply returns the treeview that is currently selected
@@ -777,44 +923,156 @@ class GUI(Frame):
         elif self.selectedAudioListType == 'Act':
             return self.ActionListView
 
-    def convert_audio(self):
+    def get_backend(self):
+        # the backend the settings say to convert with
+        if self.settings['converter'] == 'command' and self.settings['converterCommand'] != '':
+            return CommandBackend(self.settings['converterCommand'], self.settings['converterExtension'])
+        return ToolBackend(self.settings['toolPath'])
+
+    def convert_audio(self, backend = None):
+        # convert the selected audio with backend (or whichever suits each file best if it is None)
         # we need to first figure out what is selected
         sb_ids = self.getSelectedAudioIds(self.get_selectedSB())
 
-        basepath = path.split(self.getSelectedSoundbankPath())[0]
+        source = self.conversion_source()
+
+        if self.selectedAudioListType != 'Str':
+            # extract all the selected included files from the bnk in one go. This has to wait for anything else that is
+            # unpacking, so it is done on its own thread and the conversions are only submitted once it has finished
+            sb_name = self.getSelectedSoundbankName()
+            self.progbar['maximum'] = len(sb_ids)
+            unpack_thread = threading.Thread(target = lambda: self.unpack_soundbank(sb_ids, sb_name = sb_name))
+            unpack_thread.start()
+            self.submit_conversions_after(unpack_thread, sb_ids, source, backend)
+        else:
+            self.submit_conversions(sb_ids, source, backend)
+
+    def submit_conversions_after(self, thread, sb_ids, source, backend):
+        # submit the conversions once thread has finished (checked every 100ms, so the gui never waits for it)
+        if thread.is_alive():
+            self.after(100, lambda: self.submit_conversions_after(thread, sb_ids, source, backend))
+        else:
+            self.submit_conversions(sb_ids, source, backend)
+
+    def submit_conversions(self, sb_ids, source, backend):
+        self.conversions_done = 0
+        self.progbar['maximum'] = len(sb_ids)
+        self.curr_progress.set(0)
 
         # convert any selected files
         for sb_id in sb_ids:
-            new_file = path.join(self.settings['convertedPath'], "{}.ogg".format(sb_id))
-
-            new_path = path.join(self.settings['convertedPath'], "{}.WEM".format(sb_id))
-            if self.selectedAudioListType == 'Str':
-                # the path of the file will simply be the audio path + filename
-                # we need to move this file to converted, then pass *this* path to the converter
-                orig_path = path.join(basepath, self.settings['audioPath'], "{}.WEM".format(sb_id))
-                if not path.exists(orig_path):
-                    # in this case, let's just search for the file
-                    for root, dirs, files in walk(self.settings['audioPath']):
-                        for file in files:
-                            if path.splitext(file)[0] == str(sb_id):
-                                orig_path = path.join(root, file)
-                                break
-                # copy the file from the AUDIO folder to the converted folder
-                shutil.copy(orig_path, new_path)
-            else:
-                """ this will need to change I think!!! """ # maybe only a little bit...
-                # in this case we also need to extract the individual file from the bnk
-                self.unpack_soundbank([sb_id])
-                orig_path = path.join(self.settings['workingPath'], self.getSelectedSoundbankName().upper(), "{}.WEM".format(sb_id))
-                # copy the file from the TEMP folder to the converted folder
-                shutil.copy(orig_path, new_path)
-            # then convert it within that folder
-            self.conv_wem(new_path)
-            # and remove the original wem to make it less cluttered
-            remove(new_path)
-
-        # finally, we call the playback button check to cause the play button to be active again
-        self.check_file_exists(self.get_selectedSB())
+            if backend is None and self.prefetcher.adopt(sb_id) is not None:
+                # it is already being converted ahead of time
+                continue
+            # it is converted in the background, and poll_conversions tidies up when it is done
+            self.submit_conversion(sb_id, source, backend = backend)
+
+    def converted_wem_path(self, sb_id):
+        # where the wem is put to be converted
+        return path.join(self.settings['convertedPath'], "{}.WEM".format(sb_id))
+
+    def conversion_source(self):
+        # everything prepare_conversion needs to know about what is selected, so that it doesn't need the gui
+        return (self.selectedAudioListType, path.split(self.getSelectedSoundbankPath())[0],
+                self.getSelectedSoundbankName().upper(), self.get_wem_locations())
+
+    def submit_conversion(self, sb_id, source, backend = None, prefetch_order = None):
+        # convert the wem in the background. It is put in the converted folder (by prepare_conversion) by the converter too
+        new_path = self.converted_wem_path(sb_id)
+        self.converting[new_path] = self.converting.get(new_path, 0) + 1
+        prepare = lambda: self.prepare_conversion(sb_id, source)
+        if prefetch_order is None:
+            self.converter.submit(new_path, tag = sb_id, backend = backend, prepare = prepare)
+        else:
+            self.prefetcher.submit(new_path, sb_id, order = prefetch_order, prepare = prepare)
+
+    def get_wem_locations(self):
+        # the WEMLocationIndex of the current AUDIO folder. When it is first made it is brought up to date in the background
+        # (until that has finished, only a wem that it needs to look for waits for it)
+        if self.wem_locations is None or self.wem_locations.audio_path != path.abspath(self.settings['audioPath']):
+            self.wem_locations = WEMLocationIndex(self.settings['audioPath'], path.join(self.settings['cachePath'], 'wemlocations.pkl'))
+            refresh_thread = threading.Thread(target = self.wem_locations.refresh, daemon = True)
+            refresh_thread.start()
+        return self.wem_locations
+
+    def prefetch_conversions(self, tview):
+        # convert the rows after the focused one, and the rest of the selection, at a low priority so that they can be
+        # played straight away when they are got to. Only the quick checks are done here, everything that touches the wems
+        # themselves is done by the converter's threads so that moving through the list never has to wait for it
+        if not self.settings['prefetch'] or self.selectedAudioListType not in ('Str', 'Inc'):
+            return
+        iid = tview.focus()
+        if iid == '':
+            return
+        # anything waiting to be prefetched from before is probably not wanted any more
+        self.prefetcher.cancel()
+        rows = []
+        next_iid = tview.next(iid)
+        while next_iid != '' and len(rows) < self.settings['prefetchAhead']:
+            rows.append(next_iid)
+            next_iid = tview.next(next_iid)
+        rows.extend(row for row in tview.selection() if row != iid and row not in rows)
+        source = self.conversion_source()
+        for order, row in enumerate(rows):
+            sb_id = tview.item(row)['values'][1]
+            if sb_id in self.prefetcher:
+                self.prefetcher.keep(sb_id)
+                continue
+            if not self.prefetcher.has_room():
+                break
+            if self.converted_wem_path(sb_id) in self.converting or self.converted_file(sb_id) is not None:
+                continue
+            # (anything that can't be got at without unpacking the bank first just fails, and is left until it is asked for)
+            self.submit_conversion(sb_id, source, prefetch_order = order)
+
+    def prepare_conversion(self, sb_id, source):
+        # put the wem to be converted in the converted folder, and return its path there.
+        # this is run on the converter's threads, so it mustn't use the gui (source is from conversion_source)
+        list_type, basepath, sb_name, wem_locations = source
+        new_path = self.converted_wem_path(sb_id)
+        if list_type == 'Str':
+            # the path of the file will simply be the audio path + filename
+            # we need to move this file to converted, then pass *this* path to the converter
+            orig_path = path.join(basepath, self.settings['audioPath'], "{}.WEM".format(sb_id))
+            if not path.exists(orig_path):
+                # in this case, let's just look up where the file is
+                orig_path = wem_locations.locate(sb_id) or orig_path
+            # link the file from the AUDIO folder to the converted folder
+            self.store.add(orig_path, new_path)
+        else:
+            # in this case the file has already been extracted from the bnk
+            orig_path = path.join(self.settings['workingPath'], sb_name, "{}.WEM".format(sb_id))
+            with WEMPack(path.join(self.settings['workingPath'], sb_name), sb_name) as wem_pack:
+                if sb_id in wem_pack:
+                    # it was extracted into the pack, so read it straight from there
+                    self.store.link(self.store.put(wem_pack.read(sb_id)), new_path)
+                else:
+                    # link the file from the TEMP folder to the converted folder
+                    self.store.add(orig_path, new_path)
+        return new_path
+
+    def poll_conversions(self):
+        # deal with any conversions that have finished since last time. This keeps running every 100ms for as long as the gui is open
+        jobs = self.converter.poll()
+        for job in jobs:
+            prefetched = self.prefetcher.finished(job)
+            if job.error is not None and not prefetched:
+                print('Failed to convert {0}: {1}'.format(job.tag, job.error))
+            # remove the original wem to make it less cluttered (once nothing else is converting it)
+            self.converting[job.wem_path] -= 1
+            if self.converting[job.wem_path] == 0:
+                del self.converting[job.wem_path]
+                self.store.release(job.wem_path)
+            if not prefetched:
+                self.conversions_done += 1
+                self.curr_progress.set(self.conversions_done)
+        if len(jobs) != 0:
+            self.store.save()
+            self.conversion_cache.save()
+            self.get_wem_locations().save()
+            # call the playback button check to cause the play button to be active again
+            self.check_file_exists(self.get_selectedSB())
+        self.after(100, self.poll_conversions)
 
     def play_audio(self):
         # gets the selected audio and plays it (only one at a time)
@@ -825,8 +1083,8 @@ class GUI(Frame):
             messagebox.showwarning("Invalid selection!", message = "You can only playback one file at a time.")
             return
         else:
-            new_file = path.join(self.settings['convertedPath'], "{}.ogg".format(sb_ids[0]))
-            if path.exists(new_file):
+            new_file = self.converted_file(sb_ids[0])
+            if new_file is not None:
                 # define a simple function here to do playback                
                 print('play the audio')
                 self.song = pyglet.media.load(new_file)
@@ -856,16 +1114,9 @@ class GUI(Frame):
             self.stop_audio()
 
     def conv_wem(self, file):
-        # first run ww2ogg
-        exe_path = path.join(self.settings['toolPath'], 'ww2ogg', 'ww2ogg.exe')
-        # this will run the conversion process on the specified wem file
-        args = [exe_path , file, '--pcb', path.join(self.settings['toolPath'], 'ww2ogg', 'packed_codebooks_aoTuV_603.bin')]
-        subprocess.call(args = args)
-        # now run revorb on thr produced ogg file:
-        exe_path = path.join(self.settings['toolPath'], 'revorb', 'revorb.exe')
-        args = [exe_path, '{}.ogg'.format(path.splitext(file)[0])]
-        subprocess.call(args = args)
-        # now we should have a file in the same folder as the file was originally in
+        # convert the specified wem file straight away (ww2ogg then revorb).
+        # the ogg will be in the same folder as the file was originally in
+        return convert_wem(self.settings['toolPath'], file)
         
         
     def getPaths(self):
@@ -901,9 +1152,20 @@ class GUI(Frame):
         print(self.settings)
         if self.player is not None:
             self.player.pause()
+        self.converter.shutdown()
+        self.get_wem_locations().save()
+        self.conversion_cache.save()
         with open('settings.pkl', 'wb') as f:
             pickle.dump(self.settings, f)
+        # nothing else is using the store now, so this is a good time to clear out any wems that aren't needed any more
+        self.store.gc()
+        self.store.save()
+        if self.catalog is not None:
+            self.catalog.close()
         self.master.destroy()      
 
-app = GUI(master = root)
-app.mainloop()
+if __name__ == '__main__':
+    # this needs to be guarded so that the processes used to unpack all the soundbanks don't open the GUI again
+    root = Tk()
+    app = GUI(master = root)
+    app.mainloop()
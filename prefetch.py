@@ -0,0 +1,65 @@
+# file containing the prefetcher, which converts audio before it is asked for.
+# When a row is looked at, the rows after it (and the rest of the selection) are likely to be played next, so they are
+# converted in the background at a low priority. Only so many are converted at once (and only so much data), so browsing
+# quickly through a long list never builds up a big pile of conversions that nobody is going to listen to.
+
+PREFETCH_PRIORITY = 100     # jobs with a lower priority number are done first, so anything the user asks for goes ahead of these
+
+
+class Prefetcher():
+    """ Keeps track of the conversions that are being done ahead of time.
+    - converter:
+      The Converter to submit the conversions to.
+    - max_jobs:
+      Most prefetch conversions to have waiting or running at once. Defaults to the converter's workers.
+    - max_bytes:
+      Most bytes of wems to have waiting or being converted at once. """
+    def __init__(self, converter, max_jobs = None, max_bytes = 0x4000000):
+        self.converter = converter
+        self.max_jobs = max_jobs or converter.workers
+        self.max_bytes = max_bytes
+        self.jobs = dict()      # tag: ConversionJob, for every prefetch that hasn't been collected by finished() yet
+
+    def __contains__(self, tag):
+        return tag in self.jobs
+
+    @property
+    def bytes(self):
+        # size of all the wems being prefetched (the ones that haven't been started yet don't count, there can't be many of them)
+        return sum(job.size for job in self.jobs.values())
+
+    def has_room(self):
+        return len(self.jobs) < self.max_jobs and self.bytes < self.max_bytes
+
+    def cancel(self):
+        # drop any prefetches that haven't started yet (eg. because the user has moved on to somewhere else in the list)
+        for job in self.jobs.values():
+            self.converter.cancel(job)
+
+    def submit(self, wem_path, tag, order = 0, prepare = None):
+        """ Convert the wem ahead of time. The lower order is, the sooner it is done (compared to other prefetches).
+        prepare is passed on to the converter, the wem's size is counted once that has put it at wem_path """
+        job = self.converter.submit(wem_path, priority = PREFETCH_PRIORITY + order, tag = tag, prepare = prepare)
+        self.jobs[tag] = job
+        return job
+
+    def keep(self, tag):
+        # the prefetch of tag is still wanted after all, so undo cancel() for it (if it isn't too late)
+        self.converter.resume(self.jobs[tag])
+
+    def adopt(self, tag):
+        """ The user has asked for tag to be converted while it is being prefetched. It stops being a prefetch (so that it is
+        handled the same as the user's other conversions when it finishes) and its job is returned.
+        Returns None if there isn't one, or if it was cancelled before it could be started again (it then needs submitting again) """
+        job = self.jobs.get(tag)
+        if job is None or (job.cancelled and not self.converter.resume(job)):
+            return None
+        del self.jobs[tag]
+        return job
+
+    def finished(self, job):
+        # called with each job that the converter has finished. Returns True if it was a prefetch
+        if self.jobs.get(job.tag) is not job:
+            return False
+        del self.jobs[job.tag]
+        return True
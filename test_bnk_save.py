@@ -0,0 +1,238 @@
+# file containing checks that a bnk can be loaded and saved (or merged, or patched) back over itself without losing anything.
+# run with: python -m unittest test_bnk_save
+
+from struct import pack
+from os import path
+from unittest import mock
+import contextlib
+import tempfile
+import unittest
+import os
+import io
+
+import BNKcompiler
+from BNKcompiler import BNK_new, merge_banks, patch_wem
+
+
+def chunk(tag, data):
+    return tag + pack('<I', len(data)) + data
+
+def make_bnk(file_path, wems, first_id = 100, hirc = pack('<I', 0)):
+    # write a small bnk containing the wems (with ids first_id, first_id + 1...) and the HIRC data hirc
+    didx = b''
+    data = b''
+    for i, wem in enumerate(wems):
+        data += bytes(-len(data) % 16)
+        didx += pack('<III', first_id + i, len(data), len(wem))
+        data += wem
+    with open(file_path, 'wb') as f:
+        f.write(chunk(b'BKHD', pack('<IIII', 0x78, 0, 0, 0x447)) + chunk(b'DIDX', didx) +
+                chunk(b'DATA', data) + chunk(b'HIRC', hirc))
+
+def is_mapped(file_path):
+    # whether the file at file_path is memory-mapped by this process (linux only)
+    with open('/proc/self/maps') as maps:
+        return any(line.rstrip('\n').endswith(' ' + path.realpath(file_path)) for line in maps)
+
+def windows_replace(src, dst, replace = os.replace):
+    # os.replace, but failing like it does on windows when the file being replaced is mapped
+    if path.exists(dst) and is_mapped(dst):
+        raise PermissionError(13, 'The process cannot access the file because it is being used by another process', dst)
+    replace(src, dst)
+
+
+class SaveInPlaceTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.wems = [bytes([i]) * (500 + i * 37) for i in range(5)]
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def check_save_in_place(self, mapped):
+        bnk_path = path.join(self.folder.name, 'd.bnk')
+        copy_path = path.join(self.folder.name, 'e.bnk')
+        make_bnk(bnk_path, self.wems)
+        with contextlib.redirect_stdout(io.StringIO()):
+            # what it should come out as is what saving it somewhere else gives
+            BNK_new(path = bnk_path).save(copy_path)
+            with open(copy_path, 'rb') as f:
+                expected = f.read()
+            with BNK_new(path = bnk_path, mapped = mapped) as bnk, mock.patch.object(BNKcompiler.os, 'replace', windows_replace):
+                bnk.save(bnk_path)
+                # and again, now that the wems are being copied from the file that was just written
+                bnk.save(bnk_path)
+                # the bnk can still be used after being saved
+                for i, wem in enumerate(self.wems):
+                    self.assertEqual(bytes(bnk.data['DATA'].wem_data[100 + i].getdata()), wem)
+            with open(bnk_path, 'rb') as f:
+                saved = f.read()
+            self.assertEqual(len(saved), len(expected))
+            # only the bank id in the BKHD (the hash of the name) can be different
+            self.assertEqual(saved[16:], expected[16:])
+            reloaded = BNK_new(path = bnk_path)
+        for i, wem in enumerate(self.wems):
+            self.assertEqual(bytes(reloaded.data['DATA'].wem_data[100 + i].getdata()), wem)
+        self.assertFalse(path.exists(bnk_path + '.tmp'))
+
+    def test_save_in_place(self):
+        self.check_save_in_place(mapped = False)
+
+    def test_replace(self):
+        # replace one wem with a smaller one and another with one too big for its space, and check the saved bnk has both
+        bnk_path = path.join(self.folder.name, 'd.bnk')
+        make_bnk(bnk_path, self.wems)
+        new_wems = {101: b'\x11' * 100, 102: b'\x22' * 2000}
+        with contextlib.redirect_stdout(io.StringIO()):
+            bnk = BNK_new(path = bnk_path)
+            bnk.save(bnk_path)
+            for wem_id, wem in new_wems.items():
+                wem_path = path.join(self.folder.name, '{}.wem'.format(wem_id))
+                with open(wem_path, 'wb') as f:
+                    f.write(wem)
+                bnk.replace(wem_id, wem_path)
+            bnk.save(bnk_path)
+            reloaded = BNK_new(path = bnk_path)
+        wems = dict(enumerate(self.wems, 100))
+        wems.update(new_wems)
+        for wem_id, wem in wems.items():
+            self.assertEqual(bytes(reloaded.data['DATA'].wem_data[wem_id].getdata()), wem)
+            self.assertEqual(reloaded.data['DIDX'].get(wem_id), bnk.data['DIDX'].get(wem_id))
+
+    @unittest.skipUnless(path.exists('/proc/self/maps'), 'needs /proc to tell if a file is mapped')
+    def test_save_in_place_mapped(self):
+        self.check_save_in_place(mapped = True)
+
+    def test_save_in_place_mapped_fails(self):
+        # if the bnk can't be replaced it is left as it was, the tmp file is removed and the loaded bnk can still be used
+        bnk_path = path.join(self.folder.name, 'd.bnk')
+        make_bnk(bnk_path, self.wems)
+        with open(bnk_path, 'rb') as f:
+            original = f.read()
+        with contextlib.redirect_stdout(io.StringIO()):
+            with BNK_new(path = bnk_path, mapped = True) as bnk:
+                with mock.patch.object(BNKcompiler.os, 'replace', side_effect = PermissionError(13, 'in use')):
+                    with self.assertRaises(PermissionError):
+                        bnk.save(bnk_path)
+                for i, wem in enumerate(self.wems):
+                    self.assertEqual(bytes(bnk.data['DATA'].wem_data[100 + i].getdata()), wem)
+        with open(bnk_path, 'rb') as f:
+            self.assertEqual(f.read(), original)
+        self.assertFalse(path.exists(bnk_path + '.tmp'))
+
+
+class MergeInPlaceTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.wems = [bytes([i]) * (500 + i * 37) for i in range(5)]
+        self.other_wems = [bytes([0x80 + i]) * (300 + i * 53) for i in range(3)]
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def test_merge_into_input(self):
+        bnk_path = path.join(self.folder.name, 'd.bnk')
+        other_path = path.join(self.folder.name, 'o.bnk')
+        copy_path = path.join(self.folder.name, 'e.bnk')
+        make_bnk(bnk_path, self.wems)
+        # the second bank has one wem that replaces one in the first, and two new ones
+        make_bnk(other_path, self.other_wems, first_id = 104)
+        with contextlib.redirect_stdout(io.StringIO()):
+            merge_banks([bnk_path, other_path], copy_path)
+            with open(copy_path, 'rb') as f:
+                expected = f.read()
+            merge_banks([bnk_path, other_path], bnk_path)
+            with open(bnk_path, 'rb') as f:
+                merged = f.read()
+            self.assertEqual(len(merged), len(expected))
+            self.assertEqual(merged[16:], expected[16:])
+            reloaded = BNK_new(path = bnk_path)
+        wems = dict(enumerate(self.wems, 100))
+        wems.update(enumerate(self.other_wems, 104))
+        self.assertEqual(sorted(reloaded.data['DATA'].wem_data), sorted(wems))
+        for wem_id, wem in wems.items():
+            self.assertEqual(bytes(reloaded.data['DATA'].wem_data[wem_id].getdata()), wem)
+        self.assertFalse(path.exists(bnk_path + '.tmp'))
+
+
+class PatchWemTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.wems = [bytes([i]) * (500 + i * 37) for i in range(5)]
+        # two made up HIRC entries, so that it can be seen whether it is moved along with the end of the DATA intact
+        self.hirc = pack('<I', 2) + bytes(range(1, 40)) + bytes(range(200, 250))
+        self.bnk_path = path.join(self.folder.name, 'd.bnk')
+        make_bnk(self.bnk_path, self.wems, hirc = self.hirc)
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def patch(self, wem_id, wem):
+        wem_path = path.join(self.folder.name, '{}.wem'.format(wem_id))
+        with open(wem_path, 'wb') as f:
+            f.write(wem)
+        return patch_wem(self.bnk_path, wem_id, wem_path)
+
+    def check_bnk(self, new_wems):
+        # every wem (with the ones in new_wems changed) and the HIRC should be what they would be if the bnk was made with them
+        wems = dict(enumerate(self.wems, 100))
+        wems.update(new_wems)
+        with contextlib.redirect_stdout(io.StringIO()):
+            reloaded = BNK_new(path = self.bnk_path)
+        self.assertEqual(list(reloaded.data['DIDX'].ids), sorted(wems))
+        for wem_id, wem in wems.items():
+            self.assertEqual(bytes(reloaded.data['DATA'].wem_data[wem_id].getdata()), wem)
+        self.assertEqual(reloaded.data['HIRC'].getdata(), chunk(b'HIRC', self.hirc))
+        return reloaded
+
+    def check_aligned(self, bnk, wem_id):
+        # a wem put on the end of the DATA has to start on a 16 byte boundary in the file
+        self.assertEqual((bnk.data['DATA'].start_pos + bnk.data['DIDX'].get(wem_id)[0]) % 16, 0)
+
+    def slot(self, wem_id):
+        # (absolute offset, size of the space up to the next wem) of the wem in the bnk as it was made
+        with contextlib.redirect_stdout(io.StringIO()):
+            bnk = BNK_new(path = self.bnk_path)
+        i = bnk.data['DIDX'].find(wem_id)
+        offsets = bnk.data['DIDX'].offsets
+        return bnk.data['DATA'].start_pos + offsets[i], offsets[i + 1] - offsets[i]
+
+    def test_fits_in_slot(self):
+        size = path.getsize(self.bnk_path)
+        offset, slot = self.slot(101)
+        # smaller than the old one, and then bigger than it but still within its padding
+        self.assertTrue(self.patch(101, b'\x11' * 100))
+        self.assertTrue(self.patch(102, b'\x22' * self.slot(102)[1]))
+        self.check_bnk({101: b'\x11' * 100, 102: b'\x22' * self.slot(102)[1]})
+        self.assertEqual(path.getsize(self.bnk_path), size)
+        # what was left of the old wem has been blanked out
+        with open(self.bnk_path, 'rb') as f:
+            f.seek(offset + 100)
+            self.assertEqual(f.read(slot - 100), bytes(slot - 100))
+
+    def test_last_wem_grows(self):
+        self.assertFalse(self.patch(104, b'\x44' * 3000))
+        self.check_bnk({104: b'\x44' * 3000})
+
+    def test_appended(self):
+        # just one byte too big for its space is enough to have to move it
+        slot = self.slot(101)[1]
+        self.assertFalse(self.patch(101, b'\x11' * (slot + 1)))
+        self.check_aligned(self.check_bnk({101: b'\x11' * (slot + 1)}), 101)
+        self.assertFalse(self.patch(101, b'\x11' * 3000))
+        self.check_bnk({101: b'\x11' * 3000})
+        # and then again, now that the wem is at the end of the DATA
+        self.assertFalse(self.patch(101, b'\x12' * 4000))
+        self.check_bnk({101: b'\x12' * 4000})
+        # another one, so that there is something after the wem that was appended
+        self.assertFalse(self.patch(100, b'\x10' * 2000))
+        self.check_aligned(self.check_bnk({100: b'\x10' * 2000, 101: b'\x12' * 4000}), 100)
+
+    def test_missing(self):
+        with self.assertRaises(KeyError):
+            self.patch(999, b'\x00' * 10)
+        self.check_bnk({})
+
+
+if __name__ == '__main__':
+    unittest.main()
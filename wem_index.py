@@ -0,0 +1,173 @@
+# file containing the index of where every streamed wem is in the AUDIO folder.
+# The whole folder is only scanned once, after that the index is saved and each time it is refreshed only the folders
+# that have changed (checked by their modification time) are listed again, so finding a wem by its id is just a lookup.
+
+from os import path, scandir, stat, replace
+import threading
+import pickle
+
+INDEX_VERSION = 1
+
+
+class WEMLocation():
+    """ Where a wem is (relative to the audio folder), and its size and modification time when it was found """
+    __slots__ = ('path', 'size', 'mtime')
+
+    def __init__(self, path, size, mtime):
+        self.path = path
+        self.size = size
+        self.mtime = mtime
+
+    def __getstate__(self):
+        return (self.path, self.size, self.mtime)
+
+    def __setstate__(self, state):
+        self.path, self.size, self.mtime = state
+
+
+class WEMLocationIndex():
+    """ id: location of every wem under audio_path, saved to index_path.
+    Any wems that have been added, moved or removed since the index was made are found by refresh(), which locate()
+    does by itself if it can't find a wem. Can be used from any thread: a refresh works on its own copy of the index and
+    only swaps it in at the end, so looking things up never has to wait for the folder to be scanned. """
+    def __init__(self, audio_path, index_path):
+        self.audio_path = path.abspath(audio_path)
+        self.index_path = index_path
+        self.lock = threading.Lock()            # held just while folders and locations are swapped or read
+        self.refresh_lock = threading.Lock()    # held for the whole of a refresh (or save), so only one runs at a time
+        self.folders = dict()       # folder (relative to audio_path): (modification time, sub folders, names of the wems in it)
+        self.locations = dict()     # id (as a string): WEMLocation
+        self.changed = False
+        try:
+            with open(self.index_path, 'rb') as f:
+                index = pickle.load(f)
+            if index['version'] == INDEX_VERSION and index['audio_path'] == self.audio_path:
+                self.folders = index['folders']
+                self.locations = index['locations']
+        except Exception:
+            pass
+
+    def __len__(self):
+        return len(self.locations)
+
+    def __contains__(self, wem_id):
+        return str(wem_id) in self.locations
+
+    def refresh(self):
+        """ Bring the index up to date with the audio folder. Only folders that have been modified since they were last
+        looked at are listed again. Returns the number of folders that were listed """
+        with self.refresh_lock:
+            with self.lock:
+                # the dictionaries are only ever replaced, never changed, once they are in use, so copies are safe to work on
+                folders = dict(self.folders)
+                locations = dict(self.locations)
+            listed = 0
+            seen = set()
+            to_check = ['']
+            while len(to_check) != 0:
+                folder = to_check.pop()
+                seen.add(folder)
+                try:
+                    mtime = stat(path.join(self.audio_path, folder)).st_mtime_ns
+                except OSError:
+                    continue
+                cached = folders.get(folder)
+                if cached is None or cached[0] != mtime:
+                    self._list_folder(folders, locations, folder, mtime)
+                    listed += 1
+                to_check.extend(folders[folder][1])
+            # forget about any folders that aren't there any more
+            gone = [folder for folder in folders if folder not in seen]
+            for folder in gone:
+                self._forget_wems(folders, locations, folder, folders.pop(folder)[2])
+            if listed != 0 or len(gone) != 0:
+                with self.lock:
+                    self.folders = folders
+                    self.locations = locations
+                    self.changed = True
+            return listed
+
+    def locate(self, wem_id):
+        """ Returns the full path of the wem with the id, or None if there isn't one.
+        If the wem isn't where the index says (or isn't in it) the index is refreshed once to look for it """
+        location = self.get(wem_id)
+        if location is not None and path.exists(path.join(self.audio_path, location.path)):
+            return path.join(self.audio_path, location.path)
+        # it may have been added or moved since the index was last refreshed (this is cheap if nothing has changed)
+        self.refresh()
+        location = self.get(wem_id)
+        if location is None:
+            return None
+        return path.join(self.audio_path, location.path)
+
+    def get(self, wem_id):
+        # the WEMLocation of the wem with the id (as last seen by refresh), or None
+        with self.lock:
+            return self.locations.get(str(wem_id))
+
+    def save(self):
+        # save the index if it has changed. Nothing is saved while a refresh is running (it will be saved next time instead)
+        if not self.refresh_lock.acquire(blocking = False):
+            return
+        try:
+            with self.lock:
+                if not self.changed:
+                    return
+                index = {'version': INDEX_VERSION, 'audio_path': self.audio_path,
+                         'folders': self.folders, 'locations': self.locations}
+                self.changed = False
+            with open(self.index_path + '.tmp', 'wb') as f:
+                pickle.dump(index, f)
+            replace(self.index_path + '.tmp', self.index_path)
+        finally:
+            self.refresh_lock.release()
+
+    def _list_folder(self, folders, locations, folder, mtime):
+        # (re)read everything in the folder
+        old = folders.get(folder)
+        if old is not None:
+            self._forget_wems(folders, locations, folder, old[2])
+        subfolders = []
+        names = []
+        try:
+            entries = list(scandir(path.join(self.audio_path, folder)))
+        except OSError:
+            entries = []
+        for entry in entries:
+            if entry.is_dir():
+                subfolders.append(path.join(folder, entry.name))
+                continue
+            wem_id, ext = path.splitext(entry.name)
+            if ext.lower() != '.wem':
+                continue
+            names.append(entry.name)
+            # if the same wem is in more than one folder the first one found is used
+            if wem_id not in locations:
+                self._add(locations, path.join(folder, entry.name))
+        folders[folder] = (mtime, subfolders, names)
+
+    def _add(self, locations, file_path):
+        try:
+            file_stat = stat(path.join(self.audio_path, file_path))
+        except OSError:
+            return
+        wem_id = path.splitext(path.basename(file_path))[0]
+        locations[wem_id] = WEMLocation(file_path, file_stat.st_size, file_stat.st_mtime_ns)
+
+    def _forget_wems(self, folders, locations, folder, names):
+        removed = set()
+        for name in names:
+            wem_id = path.splitext(name)[0]
+            location = locations.get(wem_id)
+            if location is not None and path.dirname(location.path) == folder:
+                del locations[wem_id]
+                removed.add(wem_id)
+        if len(removed) != 0:
+            # any of them that are also in another folder can be found there instead
+            for other, (mtime, subfolders, other_names) in folders.items():
+                if other == folder:
+                    continue
+                for name in other_names:
+                    wem_id = path.splitext(name)[0]
+                    if wem_id in removed and wem_id not in locations:
+                        self._add(locations, path.join(other, name))
@@ -0,0 +1,164 @@
+# file containing the packed working format for extracted banks.
+# Instead of a file for every wem, all the wems of a bank are put one after the other into a single <NAME>.pack file,
+# with a small <NAME>.pidx index of where each one is. Having a few big files instead of thousands of tiny ones makes
+# listing, copying and repacking an extracted bank much quicker, as that is then not all spent opening and closing files.
+
+from os import path, replace, remove
+from array import array
+import pickle
+import os
+
+from wem_writer import FileSink
+
+PACK_VERSION = 1
+
+
+def pack_paths(folder, name):
+    # the (pack, index) paths of the pack of the bank called name in folder
+    return (path.join(folder, '{}.pack'.format(name)), path.join(folder, '{}.pidx'.format(name)))
+
+def has_pack(folder, name):
+    return path.exists(pack_paths(folder, name)[1])
+
+
+class WEMPack():
+    """ Read access to the pack of a bank. Any wem can be found by its id straight from the index without touching the disk. """
+    def __init__(self, folder, name):
+        self.pack_path, self.index_path = pack_paths(folder, name)
+        self.ids = array('I')
+        self.offsets = array('Q')
+        self.sizes = array('I')
+        self.file = None
+        try:
+            with open(self.index_path, 'rb') as f:
+                index = pickle.load(f)
+            # if the pack doesn't match what the index says it should be (eg. it was only half rewritten) then it isn't used
+            # (anything on the end past what the index covers is fine, it is just wems that were being added when something went wrong)
+            if index['version'] == PACK_VERSION and index['size'] <= path.getsize(self.pack_path):
+                self.ids, self.offsets, self.sizes = index['ids'], index['offsets'], index['sizes']
+        except Exception:
+            pass
+        self.index = dict(zip(self.ids, range(len(self.ids))))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, wem_id):
+        return int(wem_id) in self.index
+
+    def locate(self, wem_id):
+        # returns the (offset in the pack, size) of the wem. Raises a KeyError if it isn't in the pack
+        i = self.index[int(wem_id)]
+        return self.offsets[i], self.sizes[i]
+
+    def read(self, wem_id):
+        # returns the data of the wem
+        offset, size = self.locate(wem_id)
+        if self.file is None:
+            self.file = open(self.pack_path, 'rb')
+        if hasattr(os, 'pread'):
+            return os.pread(self.file.fileno(), size, offset)
+        self.file.seek(offset)
+        return self.file.read(size)
+
+    def extract(self, wem_id, file_path):
+        # write the wem out to its own file
+        with open(file_path, 'wb') as wem_file:
+            wem_file.write(self.read(wem_id))
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class PackSink(FileSink):
+    """ Writes the wems into the pack of the bank called name in output_path instead of into separate files.
+    Any wems already in the pack are kept (a wem that is written again just replaces the old one), unless reset is True,
+    in which case the pack is started again from nothing. Wems are only ever added to the end of the pack, so if more than
+    half of it ends up being old replaced wems it is rewritten with just the current ones when the sink is closed.
+    This can't be wrapped in an IncrementalSink as that works on the separate files. """
+    def __init__(self, output_path, name, reset = False):
+        super(PackSink, self).__init__(output_path)
+        self.pack_path, self.index_path = pack_paths(output_path, name)
+        self.entries = dict()       # id: (offset, size), in the order they are in the pack
+        if not reset:
+            with WEMPack(output_path, name) as existing:
+                for i in range(len(existing)):
+                    self.entries[existing.ids[i]] = (existing.offsets[i], existing.sizes[i])
+        if len(self.entries) == 0:
+            self.new_path = self.pack_path + '.tmp'
+            self.pack = open(self.new_path, 'wb')
+            self.end = 0
+        else:
+            # add on to the end of the pack as it is. It is still valid until the index is updated as the index doesn't cover anything new
+            self.new_path = None
+            self.pack = open(self.pack_path, 'r+b')
+            self.end = self.pack.seek(0, 2)
+
+    def save_file(self, wem_id, data):
+        # each wem starts on a 16 byte boundary, same as in the bnk
+        padding = -self.end % 16
+        if padding != 0:
+            self.pack.write(bytes(padding))
+            self.end += padding
+        self.pack.write(data)
+        self.entries.pop(int(wem_id), None)
+        self.entries[int(wem_id)] = (self.end, len(data))
+        self.end += len(data)
+
+    def flush(self):
+        self.pack.flush()
+
+    def close(self):
+        if self.pack is None:
+            return
+        self.pack.close()
+        self.pack = None
+        live_size = sum(size for offset, size in self.entries.values())
+        if self.end > 2 * live_size + 0x100000:
+            self.compact()
+        if self.new_path is not None:
+            # the old index can't be left around for the new pack
+            if path.exists(self.index_path):
+                remove(self.index_path)
+            replace(self.new_path, self.pack_path)
+        self.write_index()
+        super(PackSink, self).close()
+
+    def compact(self):
+        # rewrite the pack with only the current version of each wem
+        source_path = self.new_path or self.pack_path
+        compact_path = self.pack_path + '.compact'
+        entries = dict()
+        with open(source_path, 'rb') as source, open(compact_path, 'wb') as compacted:
+            end = 0
+            for wem_id, (offset, size) in self.entries.items():
+                padding = -end % 16
+                compacted.write(bytes(padding))
+                end += padding
+                source.seek(offset)
+                compacted.write(source.read(size))
+                entries[wem_id] = (end, size)
+                end += size
+        if self.new_path is not None:
+            remove(self.new_path)
+        self.new_path = compact_path
+        self.entries = entries
+        self.end = end
+
+    def write_index(self):
+        index = {'version': PACK_VERSION,
+                 'size': path.getsize(self.pack_path),
+                 'ids': array('I', self.entries.keys()),
+                 'offsets': array('Q', (entry[0] for entry in self.entries.values())),
+                 'sizes': array('I', (entry[1] for entry in self.entries.values()))}
+        with open(self.index_path + '.tmp', 'wb') as f:
+            pickle.dump(index, f)
+        replace(self.index_path + '.tmp', self.index_path)
@@ -0,0 +1,159 @@
+# file containing the content addressed store for wem files.
+# Every wem is stored once, in a file named by the hash of its data, and anywhere that it is needed (the working folder,
+# the output folder, the converted folder...) just gets a hard link to it (or a copy if links aren't possible).
+
+from os import path, makedirs, remove, link, replace, listdir, getpid
+from hashlib import blake2b
+import threading
+import shutil
+import pickle
+
+try:
+    import fcntl
+    FICLONE = 0x40049409        # linux ioctl to make a copy-on-write copy (reflink) of a file
+except ImportError:
+    fcntl = None
+
+
+class WEMStore():
+    """
+    Hash-named wem files with a count of how many places each one is linked to.
+    The files that are linked out of the store share their data with it, so they should never be written to directly.
+    Use link() to put something else at the same path, or release() to remove it (this is what all the code here does).
+    """
+    def __init__(self, root):
+        self.root = root
+        if not path.exists(self.root):
+            makedirs(self.root)
+        self.refs_path = path.join(self.root, 'refs.pkl')
+        self.lock = threading.RLock()
+        try:
+            with open(self.refs_path, 'rb') as f:
+                refs = pickle.load(f)
+            self.refs = refs['refs']        # hash: number of places it is linked to
+            self.links = refs['links']      # path linked to: hash
+        except Exception:
+            self.refs = dict()
+            self.links = dict()
+
+    def blob_path(self, digest):
+        # the path of the file in the store with the hash digest
+        return path.join(self.root, digest[:2], '{}.wem'.format(digest))
+
+    @staticmethod
+    def hash_data(data):
+        return blake2b(data, digest_size = 16).hexdigest()
+
+    @staticmethod
+    def hash_file(file_path):
+        hash_ = blake2b(digest_size = 16)
+        with open(file_path, 'rb') as f:
+            for block in iter(lambda: f.read(0x100000), b''):
+                hash_.update(block)
+        return hash_.hexdigest()
+
+    def put(self, data):
+        # add the wem data to the store (if it isn't already) and return its hash
+        digest = self.hash_data(data)
+        blob = self.blob_path(digest)
+        if not path.exists(blob):
+            self._make_dir(blob)
+            with open(self._tmp_path(blob), 'wb') as f:
+                f.write(data)
+            replace(self._tmp_path(blob), blob)
+        return digest
+
+    def put_file(self, file_path):
+        # add the wem file to the store (if it isn't already) and return its hash
+        digest = self.hash_file(file_path)
+        blob = self.blob_path(digest)
+        if not path.exists(blob):
+            self._make_dir(blob)
+            shutil.copyfile(file_path, self._tmp_path(blob))
+            replace(self._tmp_path(blob), blob)
+        return digest
+
+    def link(self, digest, dest):
+        """ Put the wem with the hash digest at dest. Whatever was at dest before is released first. """
+        dest = path.abspath(dest)
+        with self.lock:
+            # only skip it if dest really is still the file in the store (something else may have put a new file there since)
+            if self.links.get(dest) == digest and path.exists(dest) and path.samefile(dest, self.blob_path(digest)):
+                return
+            self.release(dest)
+            self.refs[digest] = self.refs.get(digest, 0) + 1
+            self.links[dest] = digest
+        link_or_copy(self.blob_path(digest), dest)
+
+    def add(self, file_path, dest):
+        # add the wem file to the store and put it at dest. This is what to use instead of shutil.copy
+        digest = self.links.get(path.abspath(file_path))
+        if digest is None or not path.exists(file_path) or not path.samefile(file_path, self.blob_path(digest)):
+            # if the file is already a link to something in the store we don't even need to read it, otherwise hash it and add it
+            digest = self.put_file(file_path)
+        self.link(digest, dest)
+
+    def release(self, dest):
+        """ Remove whatever is at dest, and drop its reference to the wem in the store (if it was linked from it).
+        The wem itself stays in the store until gc() is run, even if nothing uses it any more. """
+        dest = path.abspath(dest)
+        with self.lock:
+            if path.exists(dest):
+                remove(dest)
+            digest = self.links.pop(dest, None)
+            if digest is not None:
+                self.refs[digest] -= 1
+                if self.refs[digest] <= 0:
+                    del self.refs[digest]
+
+    def gc(self):
+        """ Forget about any links that have been deleted by something else, and remove any wems that are no longer used.
+        Nothing should be being added to the store while this is running. """
+        with self.lock:
+            for dest in [dest for dest in self.links if not path.exists(dest)]:
+                self.release(dest)
+            removed = 0
+            for folder in listdir(self.root):
+                if not path.isdir(path.join(self.root, folder)):
+                    continue
+                for file in listdir(path.join(self.root, folder)):
+                    digest, ext = path.splitext(file)
+                    if ext != '.wem' or self.refs.get(digest, 0) == 0:
+                        # unused wems and any temporary files left over from something that crashed
+                        remove(path.join(self.root, folder, file))
+                        removed += 1
+            return removed
+
+    def save(self):
+        # save the reference counts
+        with self.lock:
+            with open(self.refs_path + '.tmp', 'wb') as f:
+                pickle.dump({'refs': self.refs, 'links': self.links}, f)
+            replace(self.refs_path + '.tmp', self.refs_path)
+
+    @staticmethod
+    def _tmp_path(blob):
+        # each thread writes to its own temporary file so that two of them adding the same wem at once don't clash
+        return '{0}.{1}_{2}.tmp'.format(blob, getpid(), threading.get_ident())
+
+    @staticmethod
+    def _make_dir(blob):
+        if not path.exists(path.dirname(blob)):
+            makedirs(path.dirname(blob), exist_ok = True)
+
+
+def link_or_copy(src, dst):
+    # make dst have the same contents as src as cheaply as possible: a hard link, then a reflink, and finally just a copy
+    try:
+        link(src, dst)
+        return
+    except OSError:
+        pass
+    if fcntl is not None:
+        try:
+            with open(src, 'rb') as src_file, open(dst, 'wb') as dst_file:
+                fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+            return
+        except OSError:
+            pass
+    shutil.copyfile(src, dst)
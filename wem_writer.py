@@ -0,0 +1,269 @@
+# file containing the "sinks" that extracted wems are written to.
+# The extraction code just hands each wem to a sink and the sink decides how and where it ends up on disk.
+
+from os import path, makedirs, stat, link, remove, replace
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import blake2b
+import threading
+import pickle
+import time
+
+
+class FileSink():
+    """ Writes each wem to its own <id>.wem file in output_path, one after the other """
+    def __init__(self, output_path):
+        self.output_path = output_path
+        if not path.exists(self.output_path):
+            makedirs(self.output_path)
+        self.files_written = 0
+        self.bytes_written = 0
+        self.start_time = time.perf_counter()
+        self.end_time = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def wem_path(self, wem_id):
+        return path.join(self.output_path, '{}.wem'.format(wem_id))
+
+    def wants(self, wem_id, size):
+        # whether the sink needs the data of this wem at all. If not, it doesn't even need to be read from the bnk
+        return True
+
+    def write(self, wem_id, data):
+        self.write_file(wem_id, data)
+
+    def flush(self):
+        # wait until everything given to the sink is on disk
+        pass
+
+    def write_file(self, wem_id, data):
+        self.save_file(wem_id, data)
+        self.files_written += 1
+        self.bytes_written += len(data)
+
+    def save_file(self, wem_id, data):
+        # put the data of the wem on disk. This is the only thing a sink that stores the wems differently needs to change.
+        # The file that is there may be a link to one in a WEMStore (or to another wem), so it is never written over directly:
+        # the data goes into a new file that then replaces it, which leaves whatever it was linked to alone
+        tmp_path = self.wem_path(wem_id) + '.tmp'
+        try:
+            with open(tmp_path, 'wb') as wem_file:
+                wem_file.write(data)
+            replace(tmp_path, self.wem_path(wem_id))
+        except BaseException:
+            if path.exists(tmp_path):
+                remove(tmp_path)
+            raise
+
+    def close(self):
+        if self.end_time is None:
+            self.end_time = time.perf_counter()
+
+    def throughput(self):
+        # returns the (files per second, bytes per second) that have been written
+        elapsed = (self.end_time or time.perf_counter()) - self.start_time
+        if elapsed <= 0:
+            return (0, 0)
+        return (self.files_written / elapsed, self.bytes_written / elapsed)
+
+    def summary(self):
+        # what has been written, for printing once the sink has been closed (before then not everything may be counted yet)
+        files_rate, bytes_rate = self.throughput()
+        return 'Wrote {0} wems ({1:.0f} files/s, {2:.2f} MB/s)'.format(self.files_written, files_rate, bytes_rate / 0x100000)
+
+
+class ThreadedFileSink(FileSink):
+    """ Same as FileSink, but the files are written by a pool of threads so that the extraction can keep reading while they are written.
+    This helps a lot when there are lots of small files, as opening and closing each one is the slow part (especially on network drives).
+    - workers:
+      The number of threads writing files.
+    - max_queued:
+      The most bytes of wems that can be waiting to be written. Once this is reached write() waits for some to finish first,
+      so that a fast reader doesn't end up holding the entire bank in memory.
+    """
+    def __init__(self, output_path, workers = 8, max_queued = 0x4000000):
+        super(ThreadedFileSink, self).__init__(output_path)
+        self.max_queued = max_queued
+        self.queued = 0         # number of bytes waiting to be written
+        self.lock = threading.Lock()
+        self.space = threading.Condition(self.lock)
+        self.error = None
+        self.pool = ThreadPoolExecutor(max_workers = workers)
+
+    def write(self, wem_id, data):
+        with self.space:
+            # wait until there is room (but always let one through, in case a single wem is bigger than max_queued)
+            while self.queued != 0 and self.queued + len(data) > self.max_queued and self.error is None:
+                self.space.wait()
+            if self.error is not None:
+                raise self.error
+            self.queued += len(data)
+        self.pool.submit(self._write, wem_id, data)
+
+    def flush(self):
+        with self.space:
+            while self.queued != 0 and self.error is None:
+                self.space.wait()
+            if self.error is not None:
+                raise self.error
+
+    def _write(self, wem_id, data):
+        try:
+            self.save_file(wem_id, data)
+        except Exception as e:
+            with self.lock:
+                if self.error is None:
+                    self.error = e
+        with self.space:
+            self.queued -= len(data)
+            if self.error is None:
+                self.files_written += 1
+                self.bytes_written += len(data)
+            self.space.notify_all()
+
+    def close(self):
+        # wait for everything to be written
+        self.pool.shutdown(wait = True)
+        super(ThreadedFileSink, self).close()
+        if self.error is not None:
+            raise self.error
+
+
+class StoreSink(ThreadedFileSink):
+    """ Same as ThreadedFileSink, but each wem is put into a WEMStore and the file in output_path is just a link to it.
+    Wems that are the same in several banks (or projects) are then only stored on disk once. """
+    def __init__(self, store, output_path, workers = 8, max_queued = 0x4000000):
+        super(StoreSink, self).__init__(output_path, workers = workers, max_queued = max_queued)
+        self.store = store
+
+    def save_file(self, wem_id, data):
+        self.store.link(self.store.put(data), self.wem_path(wem_id))
+
+    def close(self):
+        try:
+            super(StoreSink, self).close()
+        finally:
+            self.store.save()
+
+
+class IncrementalSink():
+    """ Wraps another sink so that wems which are already in the output and haven't changed aren't written again.
+    A small manifest is kept (at manifest_path) of the size and a hash of each wem that was written, and the size and modification
+    time of the file it was written to. A wem is skipped if it matches the manifest and its file hasn't been touched since.
+    If source (the path of the bnk) is given and the bnk hasn't changed since last time, the wems don't even need to be read to be skipped.
+    A wem that has the same data as another one already written is hard linked to it instead of being written again.
+    Closing this doesn't close the wrapped sink. """
+    MANIFEST_VERSION = 1
+
+    def __init__(self, sink, manifest_path, source = None):
+        self.sink = sink
+        self.manifest_path = manifest_path
+        self.source_stat = None
+        if source is not None:
+            info = stat(source)
+            self.source_stat = (info.st_size, info.st_mtime_ns)
+        self.files_skipped = 0
+        self.files_linked = 0
+        self.pending = dict()       # id: (size, hash) of the wems given to the sink that need their file's details recorded
+
+        manifest = None
+        try:
+            with open(self.manifest_path, 'rb') as f:
+                manifest = pickle.load(f)
+            if manifest.get('version') != self.MANIFEST_VERSION:
+                manifest = None
+        except Exception:
+            # no manifest, or it is broken, so just start again
+            manifest = None
+        if manifest is None:
+            manifest = {'version': self.MANIFEST_VERSION, 'source': None, 'wems': dict()}
+        self.source_unchanged = self.source_stat is not None and manifest['source'] == self.source_stat
+        self.wems = manifest['wems']        # id: (size, hash, file size, file modification time)
+        self.by_hash = dict()               # hash: id, of the wems in the manifest
+        for wem_id in self.wems:
+            self.by_hash[self.wems[wem_id][1]] = wem_id
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def files_written(self):
+        return self.sink.files_written
+
+    def throughput(self):
+        return self.sink.throughput()
+
+    def summary(self):
+        return self.sink.summary()
+
+    def wem_path(self, wem_id):
+        return self.sink.wem_path(wem_id)
+
+    def file_unchanged(self, wem_id):
+        # whether the file of the wem is still what was written last time
+        record = self.wems.get(wem_id)
+        if record is None:
+            return False
+        try:
+            info = stat(self.wem_path(wem_id))
+        except OSError:
+            return False
+        return (info.st_size, info.st_mtime_ns) == record[2:]
+
+    def wants(self, wem_id, size):
+        if self.source_unchanged and self.wems.get(wem_id, (None,))[0] == size and self.file_unchanged(wem_id):
+            self.files_skipped += 1
+            return False
+        return self.sink.wants(wem_id, size)
+
+    def write(self, wem_id, data):
+        hash_ = blake2b(data, digest_size = 16).digest()
+        record = self.wems.get(wem_id)
+        if record is not None and record[:2] == (len(data), hash_) and self.file_unchanged(wem_id):
+            self.files_skipped += 1
+            return
+        # see if we already have a file with this data that we can just link to
+        other = self.by_hash.get(hash_)
+        if other is not None and other != wem_id and self.file_unchanged(other):
+            try:
+                if path.exists(self.wem_path(wem_id)):
+                    remove(self.wem_path(wem_id))
+                link(self.wem_path(other), self.wem_path(wem_id))
+                self.files_linked += 1
+                self.pending[wem_id] = (len(data), hash_)
+                return
+            except OSError:
+                # the file system doesn't support hard links, so just write it
+                pass
+        if path.exists(self.wem_path(wem_id)):
+            # remove the old file first in case it is hard linked to another wem, otherwise that would be changed too
+            remove(self.wem_path(wem_id))
+        self.sink.write(wem_id, data)
+        self.pending[wem_id] = (len(data), hash_)
+
+    def flush(self):
+        self.sink.flush()
+
+    def close(self):
+        # once everything is on disk, record the details of each file in the manifest
+        self.sink.flush()
+        for wem_id, (size, hash_) in self.pending.items():
+            try:
+                info = stat(self.wem_path(wem_id))
+            except OSError:
+                continue
+            self.wems[wem_id] = (size, hash_, info.st_size, info.st_mtime_ns)
+            self.by_hash[hash_] = wem_id
+        self.pending = dict()
+        manifest = {'version': self.MANIFEST_VERSION, 'source': self.source_stat, 'wems': self.wems}
+        with open(self.manifest_path + '.tmp', 'wb') as f:
+            pickle.dump(manifest, f)
+        replace(self.manifest_path + '.tmp', self.manifest_path)
+        print('Skipped {0} unchanged wems, linked {1}'.format(self.files_skipped, self.files_linked))